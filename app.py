@@ -1,590 +1,578 @@
-from fastapi import FastAPI, Form
-from fastapi.responses import HTMLResponse
-from datetime import datetime
-from typing import Dict, Any
-import sqlite3
-import secrets
-import string
-import datetime as dt
-
-app = FastAPI()
-
-# ===========================
-#  DATABASE & BUSINESS LOGIC
-# ===========================
-
-DB = 'referral.db'
-ALPHABET = ''.join([c for c in string.ascii_uppercase + string.digits if c not in "IO01"])
-
-def now():
-    return dt.datetime.utcnow()
-
-def gen_code(length=5):
-    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
-
-def init_db():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tg_id TEXT UNIQUE,
-        tg_username TEXT,
-        total_invites INTEGER DEFAULT 0,
-        total_purchases INTEGER DEFAULT 0,
-        created_at TEXT
-    )""")
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS coupons(
-        code TEXT PRIMARY KEY,
-        coupon_type TEXT,
-        discount_percent INTEGER,
-        stars_count INTEGER,
-        min_stars INTEGER DEFAULT 1,
-        owner_tg_id TEXT,
-        inviter_tg_id TEXT,
-        invited_tg_id TEXT,
-        status TEXT,
-        created_at TEXT,
-        expires_at TEXT,
-        used_at TEXT
-    )""")
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS referrals(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        inviter_tg_id TEXT,
-        invited_tg_id TEXT,
-        inviter_coupon_code TEXT,
-        invited_coupon_code TEXT,
-        status TEXT,
-        created_at TEXT,
-        completed_at TEXT
-    )""")
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS purchases(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        buyer_tg_id TEXT,
-        stars_count INTEGER,
-        coupon_code TEXT,
-        discount_percent INTEGER,
-        created_at TEXT
-    )""")
-    
-    conn.commit()
-    conn.close()
-
-def create_user(tg_id, tg_username=None):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("SELECT tg_id FROM users WHERE tg_id = ?", (tg_id,))
-    existing = cur.fetchone()
-    if not existing:
-        cur.execute("INSERT INTO users(tg_id, tg_username, created_at) VALUES(?,?,?)",
-                    (tg_id, tg_username, now().isoformat()))
-    elif tg_username:
-        cur.execute("UPDATE users SET tg_username = ? WHERE tg_id = ?", (tg_username, tg_id))
-    conn.commit()
-    conn.close()
-    return tg_id
-
-def create_coupon(coupon_type, discount_percent, stars_count, owner_tg_id=None,
-                  inviter_tg_id=None, invited_tg_id=None, min_stars=1, days_valid=30):
-    code = gen_code()
-    created = now().isoformat()
-    expires = (now() + dt.timedelta(days=days_valid)).isoformat()
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO coupons(
-            code, coupon_type, discount_percent, stars_count, min_stars,
-            owner_tg_id, inviter_tg_id, invited_tg_id, status, created_at, expires_at
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
-    """, (code, coupon_type, discount_percent, stars_count, min_stars,
-          owner_tg_id, inviter_tg_id, invited_tg_id, 'active', created, expires))
-    conn.commit()
-    conn.close()
-    return code
-
-def start_invite(inviter_tg_id, invited_tg_id,
-                 invited_discount_percent: int, inviter_reward_percent: int,
-                 inviter_username=None, invited_username=None) -> Dict[str, str]:
-    create_user(inviter_tg_id, inviter_username)
-    create_user(invited_tg_id, invited_username)
-    
-    invited_coupon = create_coupon(
-        'invited_discount', invited_discount_percent, 10,
-        owner_tg_id=invited_tg_id,
-        inviter_tg_id=inviter_tg_id,
-        invited_tg_id=invited_tg_id,
-        min_stars=10
-    )
-    
-    inviter_coupon = create_coupon(
-        'inviter_reward', inviter_reward_percent, 1,
-        owner_tg_id=inviter_tg_id,
-        inviter_tg_id=inviter_tg_id,
-        invited_tg_id=invited_tg_id,
-        min_stars=1
-    )
-    
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO referrals(
-            inviter_tg_id, invited_tg_id, inviter_coupon_code,
-            invited_coupon_code, status, created_at
-        ) VALUES (?,?,?,?,?,?)
-    """, (inviter_tg_id, invited_tg_id, inviter_coupon, invited_coupon, 'pending', now().isoformat()))
-    
-    cur.execute("UPDATE users SET total_invites = total_invites + 1 WHERE tg_id = ?", (inviter_tg_id,))
-    conn.commit()
-    conn.close()
-    
-    return {
-        'inviter_coupon': inviter_coupon,
-        'invited_coupon': invited_coupon
-    }
-
-def complete_purchase(buyer_tg_id: str, stars_count: int, coupon_code: str = None) -> Dict[str, Any]:
-    create_user(buyer_tg_id)
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    used_discount = 0
-    
-    if coupon_code:
-        cur.execute("""
-            SELECT discount_percent, min_stars, status, owner_tg_id, expires_at
-            FROM coupons WHERE code = ?
-        """, (coupon_code,))
-        coupon = cur.fetchone()
-        if not coupon:
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_not_found'}
-        
-        discount_percent, min_stars, status, owner_tg_id, expires_at = coupon
-        expires_dt = dt.datetime.fromisoformat(expires_at)
-        
-        if status != 'active':
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_not_active'}
-        if now() > expires_dt:
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_expired'}
-        if owner_tg_id != buyer_tg_id:
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_belongs_to_another_user'}
-        
-        used_discount = discount_percent
-        cur.execute("UPDATE coupons SET status = 'used', used_at = ? WHERE code = ?",
-                    (now().isoformat(), coupon_code))
-        cur.execute("UPDATE referrals SET status = 'completed', completed_at = ? WHERE invited_coupon_code = ?",
-                    (now().isoformat(), coupon_code))
-    
-    cur.execute("""
-        INSERT INTO purchases(buyer_tg_id, stars_count, coupon_code, discount_percent, created_at)
-        VALUES (?,?,?,?,?)
-    """, (buyer_tg_id, stars_count, coupon_code, used_discount, now().isoformat()))
-    
-    cur.execute("UPDATE users SET total_purchases = total_purchases + 1 WHERE tg_id = ?", (buyer_tg_id,))
-    conn.commit()
-    conn.close()
-    
-    return {'ok': True, 'stars_count': stars_count, 'used_discount_percent': used_discount}
-
-def list_coupons():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            c.code, c.coupon_type, c.discount_percent, c.stars_count, c.min_stars,
-            c.owner_tg_id, u_owner.tg_username,
-            c.inviter_tg_id, u_inviter.tg_username,
-            c.invited_tg_id, u_invited.tg_username,
-            c.status, c.created_at, c.expires_at, c.used_at
-        FROM coupons c
-        LEFT JOIN users u_owner ON c.owner_tg_id = u_owner.tg_id
-        LEFT JOIN users u_inviter ON c.inviter_tg_id = u_inviter.tg_id
-        LEFT JOIN users u_invited ON c.invited_tg_id = u_invited.tg_id
-        ORDER BY c.created_at DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def delete_coupon(code: str) -> Dict[str, Any]:
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM coupons WHERE code = ?", (code,))
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-    return {'ok': deleted, 'message': 'Coupon deleted' if deleted else 'Coupon not found'}
-
-# ===========================
-#  FASTAPI APP
-# ===========================
-
-init_db()
-
-def create_button_response(title: str, message: str, is_error: bool = False) -> str:
-    color = "#ff4500" if is_error else "#45a295"
-    return f"""
-    <html>
-    <head>
-        <title>{title}</title>
-        <style>
-            body {{ font-family: 'Segoe UI', sans-serif; margin: 30px; background: linear-gradient(135deg, #1f2833 0%, #0b0c0f 100%); color: #f0f0f0; text-align: center; }}
-            .container {{ background: #2a3440; padding: 40px; border-radius: 12px; margin: 50px auto; max-width: 600px; box-shadow: 0 4px 12px rgba(0,0,0,0.5); border-left: 5px solid {color};}}
-            h2 {{ color: {color}; }}
-            .back-button {{
-                display: inline-block;
-                padding: 12px 25px;
-                margin-top: 20px;
-                border: none;
-                border-radius: 8px;
-                font-weight: bold;
-                cursor: pointer;
-                transition: transform 0.2s, box-shadow 0.2s;
-                text-decoration: none;
-                color: #1f2833;
-                background: #66fcf1;
-                box-shadow: 0 4px 6px rgba(102, 252, 241, 0.3);
-            }}
-            .back-button:hover {{
-                transform: translateY(-2px);
-                box-shadow: 0 6px 10px rgba(102, 252, 241, 0.5);
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h2>{title}</h2>
-            {message}
-            <a href='/' class='back-button'>⬅️ Вернуться к Панели</a>
-        </div>
-    </body>
-    </html>
-    """
-
-@app.get("/", response_class=HTMLResponse)
-def home():
-    coupons = list_coupons()
-    table_rows = ""
-    for c in coupons:
-        (code, c_type, discount, stars_count, min_stars,
-         owner_id, owner_username,
-         inviter_id, inviter_username,
-         invited_id, invited_username,
-         status, created, expires, used) = c
-        
-        created_fmt = datetime.fromisoformat(created).strftime("%Y-%m-%d %H:%M:%S") if created else "-"
-        expires_fmt = datetime.fromisoformat(expires).strftime("%Y-%m-%d %H:%M:%S") if expires else "-"
-        used_fmt = datetime.fromisoformat(used).strftime("%Y-%m-%d %H:%M:%S") if used else "-"
-        
-        def format_user(tg_id, username):
-            if not tg_id:
-                return "-"
-            if username:
-                return f"{tg_id} / @{username}"
-            else:
-                return f"{tg_id} / —"
-        
-        owner_display = format_user(owner_id, owner_username)
-        inviter_display = format_user(inviter_id, inviter_username)
-        invited_display = format_user(invited_id, invited_username)
-        
-        color = "#2a3440" if status == "active" else "#1f2833" if status == "used" else "#502828" if status == "expired" else "#2a3440"
-        
-        table_rows += f"""
-        <tr style="background:{color}">
-            <td>{code}</td>
-            <td>{c_type}</td>
-            <td>{discount}%</td>
-            <td>{owner_display}</td>
-            <td>{inviter_display}</td>
-            <td>{invited_display}</td>
-            <td>{status}</td>
-            <td>{created_fmt}</td>
-            <td>{expires_fmt}</td>
-            <td>{used_fmt}</td>
-            <td><button class="delete-btn" onclick="deleteCoupon('{code}')">🗑️ Delete</button></td>
-        </tr>
-        """
-
-    html = f"""
-    <html>
-    <head>
-        <title>Referral Coupons Dashboard</title>
-        <style>
-            body {{ 
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; 
-                margin: 0; 
-                padding: 30px; 
-                background: linear-gradient(135deg, #1f2833 0%, #0b0c0f 100%); 
-                color: #f0f0f0;
-            }}
-            h1 {{ 
-                color: #66fcf1; 
-                text-align: center; 
-                margin-bottom: 40px; 
-                text-shadow: 0 0 5px rgba(102, 252, 241, 0.5);
-            }}
-            
-            .form-section {{ 
-                background: #2a3440; 
-                padding: 30px; 
-                border-radius: 16px; 
-                margin-bottom: 30px; 
-                box-shadow: 0 4px 25px rgba(0,0,0,0.3); 
-                border: 1px solid rgba(69, 162, 149, 0.2);
-                transition: all 0.3s ease;
-                position: relative;
-                overflow: hidden;
-            }}
-            .form-section::before {{
-                content: '';
-                position: absolute;
-                top: 0;
-                left: 0;
-                width: 100%;
-                height: 3px;
-                background: linear-gradient(90deg, #45a295, #66fcf1);
-            }}
-            .form-section:hover {{
-                transform: translateY(-5px);
-                box-shadow: 0 8px 35px rgba(0,0,0,0.4);
-            }}
-            .form-section h2 {{
-                color: #66fcf1;
-                border-bottom: 2px solid rgba(31, 40, 51, 0.5);
-                padding-bottom: 15px;
-                margin-top: 0;
-                margin-bottom: 25px;
-                font-size: 1.5em;
-                letter-spacing: 1px;
-            }}
-            
-            input[type=text], input[type=number] {{ 
-                padding: 15px 20px; 
-                margin: 8px 0; 
-                width: 100%; 
-                border-radius: 12px; 
-                border: 2px solid #45a295; 
-                background: rgba(31, 40, 51, 0.7);
-                color: #f0f0f0; 
-                box-sizing: border-box;
-                transition: all 0.3s ease;
-                font-size: 1em;
-                letter-spacing: 0.5px;
-                backdrop-filter: blur(5px);
-            }}
-            
-            input[type=number]::-webkit-inner-spin-button,
-            input[type=number]::-webkit-outer-spin-button {{
-                -webkit-appearance: none;
-                margin: 0;
-            }}
-            input[type=number] {{
-                -moz-appearance: textfield;
-            }}
-            
-            input[type=text]:hover, input[type=number]:hover {{
-                border-color: #66fcf1;
-                background: rgba(31, 40, 51, 0.8);
-                transform: translateY(-1px);
-                box-shadow: 0 5px 15px rgba(102, 252, 241, 0.1);
-            }}
-            
-            input[type=text]:focus, input[type=number]:focus {{
-                border-color: #66fcf1;
-                box-shadow: 0 0 20px rgba(102, 252, 241, 0.2);
-                outline: none;
-                background: rgba(31, 40, 51, 0.9);
-                transform: translateY(-2px);
-            }}
-            
-            input::placeholder {{
-                color: #7a8b9c;
-            }}
-            
-            input:focus::placeholder {{
-                opacity: 0.7;
-                transform: translateX(5px);
-            }}
-            
-            input[type=submit] {{ 
-                background: linear-gradient(45deg, #45a295, #378579); 
-                color: #fff; 
-                border: none; 
-                cursor: pointer; 
-                font-weight: bold;
-                letter-spacing: 1px;
-                box-shadow: 0 4px 15px rgba(69, 162, 149, 0.3);
-                padding: 15px 30px; 
-                margin-top: 20px;
-                border-radius: 12px; 
-                width: 100%;
-                transition: all 0.3s ease;
-                text-transform: uppercase;
-                font-size: 0.9em;
-            }}
-            input[type=submit]:hover {{ 
-                background: linear-gradient(45deg, #378579, #2a6a61);
-                box-shadow: 0 6px 20px rgba(69, 162, 149, 0.4);
-                transform: translateY(-2px);
-            }}
-            input[type=submit]:active {{
-                transform: translateY(1px);
-                box-shadow: 0 2px 10px rgba(69, 162, 149, 0.2);
-            }}
-            
-            table {{ 
-                width: 100%; 
-                border-collapse: collapse; 
-                background: #2a3440; 
-                border-radius: 12px; 
-                overflow: hidden; 
-                box-shadow: 0 4px 12px rgba(0,0,0,0.5);
-                margin-top: 20px;
-            }}
-            th, td {{ 
-                padding: 15px 10px; 
-                border-bottom: 1px solid #1f2833; 
-                text-align: left;
-                font-size: 0.9em;
-            }}
-            th {{ 
-                background: #1f2833; 
-                color: #66fcf1; 
-                font-weight: 600; 
-                position: sticky; 
-                top: 0; 
-                letter-spacing: 0.1px;
-            }}
-            tr:hover {{ 
-                background: #3a4759 !important; 
-                transition: background-color 0.2s;
-            }}
-            
-            .delete-btn {{ 
-                background: #ff4500; 
-                color: white; 
-                border: none; 
-                padding: 6px 12px; 
-                border-radius: 6px; 
-                cursor: pointer; 
-                font-size: 0.8em; 
-                transition: background-color 0.3s;
-            }}
-            .delete-btn:hover {{ 
-                background: #cc3700; 
-            }}
-        </style>
-        <script>
-            async function deleteCoupon(code) {{
-                if (confirm('Are you sure you want to delete coupon ' + code + '?')) {{
-                    const response = await fetch(`/coupon/${{code}}`, {{ method:'DELETE' }});
-                    const result = await response.json();
-                    if(result.ok) window.location.reload();
-                    else alert('Failed to delete coupon: ' + result.message);
-                }}
-            }}
-        </script>
-    </head>
-    <body>
-        <h1>⭐ Referral Coupons Dashboard ⭐</h1>
-        
-        <div class="form-section" id="invite-section">
-            <h2>🤝 Создать Реферал</h2>
-            <form action="/invite" method="post">
-                <input name="inviter_id" placeholder="ID Пригласившего (required)" required>
-                <input name="inviter_username" placeholder="Username Пригласившего (optional)">
-                <input name="invited_id" placeholder="ID Приглашенного (required)" required>
-                <input name="invited_username" placeholder="Username Приглашенного (optional)">
-                <input name="invited_discount" type="number" placeholder="Скидка для Приглашенного (%)" required min="1" max="99">
-                <input name="inviter_reward" type="number" placeholder="Награда Пригласившему (%)" required min="1" max="99">
-                <input type="submit" value="Создать Реферальную Пару">
-            </form>
-        </div>
-
-        <div class="form-section" id="purchase-section">
-            <h2>🛒 Совершить Покупку</h2>
-            <form action="/purchase" method="post">
-                <input name="buyer_id" placeholder="ID Покупателя (required)" required>
-                <input name="coupon" placeholder="Код Купона (optional)">
-                <input type="submit" value="Применить Купон и Купить">
-            </form>
-        </div>
-
-        <h2>📜 Все Купоны</h2>
-        <table>
-            <tr>
-                <th>Код</th>
-                <th>Тип</th>
-                <th>Скидка</th>
-                <th>Владелец (ID / @Username)</th>
-                <th>Пригласивший (ID / @Username)</th>
-                <th>Приглашенный (ID / @Username)</th>
-                <th>Статус</th>
-                <th>Создан</th>
-                <th>Истекает</th>
-                <th>Использован</th>
-                <th>Действия</th>
-            </tr>
-            {table_rows}
-        </table>
-    </body>
-    </html>
-    """
-    return HTMLResponse(html)
-
-@app.post("/invite", response_class=HTMLResponse)
-def invite_form(
-    inviter_id: str = Form(...),
-    invited_id: str = Form(...),
-    invited_discount: int = Form(...),
-    inviter_reward: int = Form(...),
-    inviter_username: str = Form(None),
-    invited_username: str = Form(None)
-):
-    try:
-        if inviter_id == invited_id:
-            raise ValueError("Inviter and Invited IDs cannot be the same.")
-        result = start_invite(
-            inviter_id, invited_id,
-            invited_discount, inviter_reward,
-            inviter_username, invited_username
-        )
-        message = f"""
-            <p>Купон для Пригласившего ({inviter_reward}%): <b>{result['inviter_coupon']}</b></p>
-            <p>Купон для Приглашенного ({invited_discount}%): <b>{result['invited_coupon']}</b></p>
-        """
-        return create_button_response("✅ Успех!", message, is_error=False)
-    except Exception as e:
-        message = f"<p>Не удалось создать приглашение: <b>{e}</b></p>"
-        return create_button_response("❌ Ошибка!", message, is_error=True)
-
-@app.post("/purchase", response_class=HTMLResponse)
-def purchase_form(buyer_id: str = Form(...), coupon: str = Form(None)):
-    stars_count = 1
-    try:
-        result = complete_purchase(buyer_id, stars_count, coupon)
-        if result['ok']:
-            message = f"""
-                <p>Использована Скидка: <b>{result['used_discount_percent']}%</b></p>
-            """
-            return create_button_response("🎉 Покупка Завершена!", message, is_error=False)
-        else:
-            message = f"<p>Причина: <b>{result['reason']}</b></p>"
-            return create_button_response("❌ Покупка Не Удалась!", message, is_error=True)
-    except Exception as e:
-        message = f"<p>Ошибка: <b>{e}</b></p>"
-        return create_button_response("❌ Непредвиденная Ошибка!", message, is_error=True)
-
-@app.delete("/coupon/{code}")
-def delete_coupon_endpoint(code: str) -> Dict[str, Any]:
-    return delete_coupon(code)
+from fastapi import FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
+from string import Template
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import quote, urlencode
+import html
+import asyncio
+import hashlib
+import time
+
+from referral_system import (
+    init_db, start_invite, complete_purchase, coupons_page, delete_coupon,
+    validate_coupon, CodePoolRefiller, ExpirySweeper, Archiver, code_pool_stats, coupon_cache_stats,
+    expiry_stats, archive_stats, submit_purchase, start_group_commit, stop_group_commit, GROUP_COMMIT,
+    read_stats, export_chunk, EXPORT_TABLES, import_invites_chunk, IMPORT_CHUNK,
+    cached_purchase, idempotent_purchase, IdempotencySweeper, idempotency_stats,
+    COUPON_FILTERS, TG_ROLES, SEARCH_CODE_PREFIX_MIN,
+)
+import referral_system
+from export import ExportEncoder, EXPORT_FORMATS, parse_date
+from importer import ImportReport, aiter_lines, parse_ndjson_line
+import metrics
+import sqltrace
+from ratelimit import RateLimited, invite_admission, purchase_admission
+from db_executor import db, DBBusy
+
+# ===========================
+#  FASTAPI APP
+# ===========================
+
+init_db()
+
+# Фоновые потоки живут столько же, сколько приложение
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    workers = [CodePoolRefiller(), ExpirySweeper(), Archiver(), IdempotencySweeper()]
+    for worker in workers:
+        worker.start()
+    if GROUP_COMMIT:
+        start_group_commit()
+    try:
+        yield
+    finally:
+        stop_group_commit()
+        for worker in workers:
+            worker.stop()
+        db.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+if sqltrace.SQL_TRACE:
+    app.add_middleware(sqltrace.SQLTraceMiddleware)
+
+# Очередь к базе переполнена — отказываем сразу, клиент повторит позже
+@app.exception_handler(DBBusy)
+async def db_busy_handler(request: Request, exc: DBBusy):
+    return JSONResponse({'ok': False, 'reason': 'db_busy'}, status_code=503,
+                        headers={'Retry-After': '1'})
+
+# Admission control: клиент превысил свой или общий лимит запросов
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse({'ok': False, 'reason': 'rate_limited', 'scope': exc.scope}, status_code=429,
+                        headers={'Retry-After': exc.header()})
+
+# ===========================
+#  STATIC ASSETS & TEMPLATES
+# ===========================
+
+# Файлы из static/ читаются один раз при старте и отдаются по адресу с хэшем
+# содержимого: браузер кэширует их навсегда, а новая версия получает новый URL.
+STATIC_DIR = Path(__file__).parent / 'static'
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MEDIA_TYPES = {'.css': "text/css; charset=utf-8", '.js': "application/javascript; charset=utf-8"}
+
+ASSETS: Dict[str, Tuple[bytes, str, str]] = {}  # имя с хэшем -> (содержимое, тип, etag)
+ASSET_URLS: Dict[str, str] = {}  # исходное имя -> URL
+
+def load_assets():
+    for path in sorted(STATIC_DIR.iterdir()):
+        if path.suffix not in MEDIA_TYPES:
+            continue
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        hashed_name = f"{path.stem}.{digest}{path.suffix}"
+        ASSETS[hashed_name] = (data, MEDIA_TYPES[path.suffix], f'"{digest}"')
+        ASSET_URLS[path.name] = f"/static/{hashed_name}"
+
+def asset_url(name: str) -> str:
+    return ASSET_URLS[name]
+
+load_assets()
+
+# Шаблон страницы результата компилируется один раз
+RESULT_PAGE = Template("""
+    <html>
+    <head>
+        <title>$title</title>
+        <link rel="stylesheet" href="$stylesheet">
+    </head>
+    <body>
+        <div class="container $status">
+            <h2>$title</h2>
+            $message
+            <a href='/' class='back-button'>⬅️ Вернуться к Панели</a>
+        </div>
+    </body>
+    </html>
+""")
+
+def create_button_response(title: str, message: str, is_error: bool = False) -> str:
+    return RESULT_PAGE.substitute(
+        title=title,
+        message=message,
+        status="error" if is_error else "ok",
+        stylesheet=asset_url('result.css'),
+    )
+
+@app.get("/static/{name}")
+async def static_asset(name: str, if_none_match: Optional[str] = Header(None)):
+    asset = ASSETS.get(name)
+    if asset is None:
+        raise HTTPException(status_code=404)
+    data, media_type, etag = asset
+    headers = {'Cache-Control': STATIC_CACHE_CONTROL, 'ETag': etag}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type=media_type, headers=headers)
+
+# ===========================
+#  DASHBOARD
+# ===========================
+
+# Курсор страницы в URL: "<created_at>|<code>"
+def encode_cursor(cursor) -> str:
+    return quote(f"{cursor[0]}|{cursor[1]}")
+
+def decode_cursor(value: Optional[str]):
+    if not value or '|' not in value:
+        return None
+    created_at, code = value.rsplit('|', 1)
+    try:
+        return (int(created_at), code)
+    except ValueError:
+        return None
+
+# query — непустые параметры поиска из URL, переходы по страницам их сохраняют
+def pagination_links(page: Dict[str, Any], archived: bool = False,
+                     query: Optional[Dict[str, str]] = None) -> str:
+    links = []
+    suffix = html.escape(''.join(f'&{urlencode({k: v})}' for k, v in (query or {}).items()), quote=True)
+    suffix += '&archived=1' if archived else ''
+    if page['prev']:
+        links.append(f"<a class='page-link' href='/?after={encode_cursor(page['prev'])}{suffix}'>⬅️ Новее</a>")
+    if page['next']:
+        links.append(f"<a class='page-link' href='/?before={encode_cursor(page['next'])}{suffix}'>Старее ➡️</a>")
+    if archived:
+        links.append("<a class='page-link' href='/'>Без архива</a>")
+    else:
+        links.append("<a class='page-link' href='/?archived=1'>С архивом</a>")
+    return f"<div class='pagination'>{' '.join(links)}</div>"
+
+COUPON_STATUSES = ('active', 'used', 'expired')
+COUPON_TYPES = ('invited_discount', 'inviter_reward')
+
+def _options(values, selected: Optional[str]) -> str:
+    return ''.join(f"<option value='{v}'{' selected' if v == selected else ''}>{v}</option>"
+                   for v in ('', *values))
+
+# Форма поиска с текущими значениями; значения из URL экранируются
+def search_form(query: Dict[str, str], archived: bool) -> str:
+    def value(name):
+        return html.escape(query.get(name, ''), quote=True)
+    return f"""
+        <div class="form-section" id="search-section">
+            <h2>🔍 Поиск Купонов</h2>
+            <form action="/" method="get">
+                <input type="text" name="code" placeholder="Код или его начало (от {SEARCH_CODE_PREFIX_MIN} символов)" value="{value('code')}">
+                <input type="text" name="tg_id" placeholder="tg_id" value="{value('tg_id')}">
+                <input type="text" name="username" placeholder="@username" value="{value('username')}">
+                <label>Роль <select name="role">{_options(TG_ROLES, query.get('role'))}</select></label>
+                <label>Статус <select name="status">{_options(COUPON_STATUSES, query.get('status'))}</select></label>
+                <label>Тип <select name="coupon_type">{_options(COUPON_TYPES, query.get('coupon_type'))}</select></label>
+                <label>Создан с <input type="date" name="created_from" value="{value('created_from')}"></label>
+                <label>по <input type="date" name="created_until" value="{value('created_until')}"></label>
+                <label><input type="checkbox" name="archived" value="1"{' checked' if archived else ''}> С архивом</label>
+                <input type="submit" value="Найти">
+            </form>
+        </div>
+"""
+
+# Статичная часть страницы отдается первой, до обращения к базе
+DASHBOARD_HEAD = f"""
+    <html>
+    <head>
+        <title>Referral Coupons Dashboard</title>
+        <link rel="stylesheet" href="{asset_url('dashboard.css')}">
+        <script src="{asset_url('dashboard.js')}"></script>
+    </head>
+    <body>
+        <h1>⭐ Referral Coupons Dashboard ⭐</h1>
+        
+        <div class="form-section" id="invite-section">
+            <h2>🤝 Создать Реферал</h2>
+            <form action="/invite" method="post">
+                <input name="inviter_id" placeholder="ID Пригласившего (required)" required>
+                <input name="inviter_username" placeholder="Username Пригласившего (optional)">
+                <input name="invited_id" placeholder="ID Приглашенного (required)" required>
+                <input name="invited_username" placeholder="Username Приглашенного (optional)">
+                <input name="invited_discount" type="number" placeholder="Скидка для Приглашенного (%)" required min="1" max="99">
+                <input name="inviter_reward" type="number" placeholder="Награда Пригласившему (%)" required min="1" max="99">
+                <input type="submit" value="Создать Реферальную Пару">
+            </form>
+        </div>
+
+        <div class="form-section" id="purchase-section">
+            <h2>🛒 Совершить Покупку</h2>
+            <form action="/purchase" method="post">
+                <input name="buyer_id" placeholder="ID Покупателя (required)" required>
+                <input name="coupon" placeholder="Код Купона (optional)">
+                <input type="submit" value="Применить Купон и Купить">
+            </form>
+        </div>
+"""
+
+DASHBOARD_TABLE_HEAD = """
+        <h2>📜 Все Купоны</h2>
+        <table>
+            <tr>
+                <th>Код</th>
+                <th>Тип</th>
+                <th>Скидка</th>
+                <th>Владелец (ID / @Username)</th>
+                <th>Пригласивший (ID / @Username)</th>
+                <th>Приглашенный (ID / @Username)</th>
+                <th>Статус</th>
+                <th>Создан</th>
+                <th>Истекает</th>
+                <th>Использован</th>
+                <th>Действия</th>
+            </tr>
+"""
+
+DASHBOARD_FOOTER = """
+        </table>
+        {pagination}
+    </body>
+    </html>
+"""
+
+# Строки отдаются пачками по ROW_CHUNK, чтобы не гонять по чанку на строку
+ROW_CHUNK = 25
+
+STATUS_COLORS = {'active': "#2a3440", 'used': "#1f2833", 'expired': "#502828"}
+
+def format_user(tg_id, username):
+    if not tg_id:
+        return "-"
+    if username:
+        return f"{tg_id} / @{username}"
+    else:
+        return f"{tg_id} / —"
+
+# Epoch-секунды UTC; у купонов одной пачки время часто совпадает
+@lru_cache(maxsize=4096)
+def format_ts(value):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(value)) if value else "-"
+
+def render_row(c) -> str:
+    (code, c_type, discount, stars_count, min_stars,
+     owner_id, owner_username,
+     inviter_id, inviter_username,
+     invited_id, invited_username,
+     status, created, expires, used) = c
+    
+    color = STATUS_COLORS.get(status, "#2a3440")
+    
+    return f"""
+        <tr style="background:{color}">
+            <td>{code}</td>
+            <td>{c_type}</td>
+            <td>{discount}%</td>
+            <td>{format_user(owner_id, owner_username)}</td>
+            <td>{format_user(inviter_id, inviter_username)}</td>
+            <td>{format_user(invited_id, invited_username)}</td>
+            <td>{status}</td>
+            <td>{format_ts(created)}</td>
+            <td>{format_ts(expires)}</td>
+            <td>{format_ts(used)}</td>
+            <td><button class="delete-btn" onclick="deleteCoupon('{code}')">🗑️ Delete</button></td>
+        </tr>
+        """
+
+# Страница читается одним вызовом в пуле базы до начала ответа (соединения SQLite
+# привязаны к потоку, а DBBusy после отправленного заголовка стал бы обрезанной
+# страницей вместо 503); генератор только отдает ее кусками.
+async def render_dashboard(page, archived=False, query=None):
+    query = query or {}
+    yield DASHBOARD_HEAD + search_form(query, archived) + DASHBOARD_TABLE_HEAD
+    rows = page['rows']
+    for i in range(0, len(rows), ROW_CHUNK):
+        yield ''.join(render_row(c) for c in rows[i:i + ROW_CHUNK])
+    yield DASHBOARD_FOOTER.format(pagination=pagination_links(page, archived, query))
+
+# Поиск: code — префикс кода, tg_id/username — купоны пользователя (role —
+# owner/inviter/invited, по умолчанию любая), created_from/created_until — даты
+# ISO-8601 (с — включительно, по — нет). Фильтры выполняет search_coupons.
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request, before: Optional[str] = None, after: Optional[str] = None,
+               archived: bool = False):
+    query = {name: request.query_params[name].strip() for name in COUPON_FILTERS
+             if request.query_params.get(name, '').strip()}
+    if query.get('role') and query['role'] not in TG_ROLES:
+        raise HTTPException(status_code=400, detail=f"role must be one of {', '.join(TG_ROLES)}")
+    if query.get('code') and len(query['code']) < SEARCH_CODE_PREFIX_MIN:
+        raise HTTPException(status_code=400,
+                            detail=f"code prefix must be at least {SEARCH_CODE_PREFIX_MIN} characters")
+    filters: Dict[str, Any] = dict(query)
+    try:
+        for name in ('created_from', 'created_until'):
+            filters[name] = parse_date(query.get(name))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid date: {e}")
+    try:
+        page = await db.run(coupons_page, before=decode_cursor(before), after=decode_cursor(after),
+                            include_archived=archived, filters=filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(render_dashboard(page, archived, query),
+                             media_type="text/html; charset=utf-8")
+
+@app.post("/invite", response_class=HTMLResponse)
+async def invite_form(
+    inviter_id: str = Form(...),
+    invited_id: str = Form(...),
+    invited_discount: int = Form(...),
+    inviter_reward: int = Form(...),
+    inviter_username: str = Form(None),
+    invited_username: str = Form(None)
+):
+    invite_admission.check(inviter_id)
+    try:
+        if inviter_id == invited_id:
+            raise ValueError("Inviter and Invited IDs cannot be the same.")
+        result = await db.run(
+            start_invite,
+            inviter_id, invited_id,
+            invited_discount, inviter_reward,
+            inviter_username, invited_username
+        )
+        message = f"""
+            <p>Купон для Пригласившего ({inviter_reward}%): <b>{result['inviter_coupon']}</b></p>
+            <p>Купон для Приглашенного ({invited_discount}%): <b>{result['invited_coupon']}</b></p>
+        """
+        return create_button_response("✅ Успех!", message, is_error=False)
+    except DBBusy:
+        raise
+    except Exception as e:
+        message = f"<p>Не удалось создать приглашение: <b>{e}</b></p>"
+        return create_button_response("❌ Ошибка!", message, is_error=True)
+
+# Импорт рефералов партнеров. NDJSON (по объекту на строку) читается потоком
+# и пишется пачками по chunk_size строк, каждая пачка — один вызов пула.
+# application/json — массив объектов или {"invites": [...]}, разбирается целиком.
+# Ошибочные строки попадают в errors с номером строки и не прерывают импорт.
+@app.post("/invites/batch")
+async def import_invites_batch(request: Request, chunk_size: int = IMPORT_CHUNK) -> Dict[str, Any]:
+    if not 1 <= chunk_size <= 10000:
+        raise HTTPException(status_code=400, detail="chunk_size must be between 1 and 10000")
+    report = ImportReport()
+    chunk = []
+    
+    async def flush():
+        report.add(await db.run(import_invites_chunk, chunk[:]))
+        chunk.clear()
+    
+    if request.headers.get('content-type', '').startswith('application/json'):
+        try:
+            body = await request.json()
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"invalid JSON: {e}")
+        items = body.get('invites') if isinstance(body, dict) else body
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="expected a list of invites")
+        for line_no, row in enumerate(items, 1):
+            chunk.append((line_no, row))
+            if len(chunk) >= chunk_size:
+                await flush()
+    else:
+        line_no = 0
+        async for line in aiter_lines(request.stream()):
+            line_no += 1
+            row = parse_ndjson_line(line_no, line, report)
+            if row is not None:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    await flush()
+    if chunk:
+        await flush()
+    return report.as_dict()
+
+# С GROUP_COMMIT=1 покупки пишет общий писатель пачками, иначе — пул базы.
+# С ключом идемпотентности повтор, найденный в кэше, отдается без пула.
+async def run_purchase(buyer_id: str, stars_count: int, coupon: Optional[str],
+                       idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    idempotency_key = idempotency_key or None
+    if idempotency_key is not None:
+        result = cached_purchase(idempotency_key, buyer_id, stars_count, coupon)
+        if result is not None:
+            return result
+    if referral_system.purchase_writer is not None:
+        return await asyncio.wrap_future(submit_purchase(buyer_id, stars_count, coupon, idempotency_key))
+    if idempotency_key is not None:
+        return await db.run(idempotent_purchase, idempotency_key, buyer_id, stars_count, coupon)
+    return await db.run(complete_purchase, buyer_id, stars_count, coupon)
+
+# Ключ — из заголовка Idempotency-Key или скрытого поля формы idempotency_key
+@app.post("/purchase", response_class=HTMLResponse)
+async def purchase_form(buyer_id: str = Form(...), coupon: str = Form(None),
+                        idempotency_key: str = Form(None),
+                        idempotency_key_header: Optional[str] = Header(None, alias='Idempotency-Key')):
+    purchase_admission.check(buyer_id)
+    stars_count = 1
+    try:
+        result = await run_purchase(buyer_id, stars_count, coupon,
+                                    idempotency_key_header or idempotency_key)
+        if result['ok']:
+            message = f"""
+                <p>Использована Скидка: <b>{result['used_discount_percent']}%</b></p>
+            """
+            return create_button_response("🎉 Покупка Завершена!", message, is_error=False)
+        else:
+            message = f"<p>Причина: <b>{result['reason']}</b></p>"
+            return create_button_response("❌ Покупка Не Удалась!", message, is_error=True)
+    except DBBusy:
+        raise
+    except Exception as e:
+        message = f"<p>Ошибка: <b>{e}</b></p>"
+        return create_button_response("❌ Непредвиденная Ошибка!", message, is_error=True)
+
+class PurchaseRequest(BaseModel):
+    buyer_id: str
+    stars_count: int = Field(1, ge=1)
+    coupon: Optional[str] = None
+
+# Покупка для бота. Повтор с тем же Idempotency-Key возвращает первый результат;
+# тот же ключ с другими параметрами — 422.
+@app.post("/purchases")
+async def purchase_api(body: PurchaseRequest,
+                       idempotency_key: Optional[str] = Header(None, alias='Idempotency-Key')) -> Dict[str, Any]:
+    purchase_admission.check(body.buyer_id)
+    try:
+        return await run_purchase(body.buyer_id, body.stars_count, body.coupon, idempotency_key)
+    except ValueError as e:  # IdempotencyConflict, слишком длинный ключ
+        raise HTTPException(status_code=422, detail=str(e))
+
+# Проверка кода ботом до подтверждения покупки (из кэша купонов)
+@app.get("/coupon/{code}")
+async def validate_coupon_endpoint(code: str, buyer_id: str) -> Dict[str, Any]:
+    return await db.run(validate_coupon, code, buyer_id)
+
+@app.delete("/coupon/{code}")
+async def delete_coupon_endpoint(code: str) -> Dict[str, Any]:
+    return await db.run(delete_coupon, code)
+
+# Выгрузка для финансов: куски по EXPORT_CHUNK строк читаются отдельными
+# вызовами пула и сразу уходят клиенту, память не зависит от размера таблицы.
+# since — включительно, until — нет; даты ISO-8601, без зоны — UTC.
+# archived=0 — только горячие таблицы, без перенесенных в архив строк.
+@app.get("/export/{table}")
+async def export_table(table: str, format: str = 'csv', gzip: bool = False,
+                       since: Optional[str] = None, until: Optional[str] = None,
+                       status: Optional[str] = None, archived: bool = True) -> StreamingResponse:
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table: {table}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if status is not None and not EXPORT_TABLES[table][2]:
+        raise HTTPException(status_code=400, detail=f"{table} has no status")
+    try:
+        since_ts, until_ts = parse_date(since), parse_date(until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    encoder = ExportEncoder(table, format, gzip)
+    # Первый кусок — до начала ответа: если пул занят, клиент получит 503, а не
+    # файл из одного заголовка. Дальше DBBusy уже обрывает начатую выгрузку.
+    rows, after = await db.run(export_chunk, table, since_ts, until_ts, status, None,
+                               include_archived=archived)
+
+    async def body(rows, after):
+        yield encoder.header()
+        while True:
+            data = encoder.rows(rows)
+            if data:
+                yield data
+            if after is None:
+                break
+            rows, after = await db.run(export_chunk, table, since_ts, until_ts, status, after,
+                                       include_archived=archived)
+        yield encoder.finish()
+
+    return StreamingResponse(body(rows, after), media_type=encoder.media_type, headers={
+        'Content-Disposition': f'attachment; filename="{encoder.filename}"'})
+
+# Сводка по купонам, рефералам и покупкам из таблицы stats (без сканов)
+@app.get("/stats")
+async def stats_endpoint() -> Dict[str, Any]:
+    return await db.run(read_stats)
+
+# Сводка из таблицы stats и статистика, которой нужна база — одним вызовом пула
+def db_metric_samples():
+    stats = read_stats()
+    samples = [('referral_coupons', {'coupon_type': coupon_type, 'status': status}, count)
+               for coupon_type, statuses in stats['coupons'].items()
+               for status, count in statuses.items()]
+    samples += [('referral_referrals', {'status': status}, count)
+                for status, count in stats['referrals'].items()]
+    samples.append(('referral_purchases', {}, stats['purchases']))
+    samples.append(('referral_discount_percent', {}, stats['discount_percent_total']))
+    return samples + metrics.flat_samples('referral_code_pool', code_pool_stats())
+
+# Prometheus. Если очередь к базе переполнена, отдаем то, что есть в памяти
+@app.get("/metrics")
+async def prometheus_metrics() -> Response:
+    try:
+        samples = await db.run(db_metric_samples)
+    except DBBusy:
+        samples = []
+    samples += metrics.flat_samples('referral_coupon_cache', coupon_cache_stats())
+    samples += metrics.flat_samples('referral_expiry', expiry_stats())
+    samples += metrics.flat_samples('referral_archive', archive_stats())
+    samples += metrics.flat_samples('referral_idempotency_cache', idempotency_stats())
+    samples += metrics.flat_samples('referral_admission', invite_admission.stats(), {'endpoint': 'invite'})
+    samples += metrics.flat_samples('referral_admission', purchase_admission.stats(), {'endpoint': 'purchase'})
+    samples += metrics.flat_samples('referral_db_executor', db.stats())
+    writer = referral_system.purchase_writer
+    if writer is not None:
+        samples += metrics.flat_samples('referral_group_commit', writer.stats())
+    return Response(metrics.render(samples), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/metrics/code-pool")
+async def code_pool_metrics() -> Dict[str, Any]:
+    return await db.run(code_pool_stats)
+
+@app.get("/metrics/coupon-cache")
+async def coupon_cache_metrics() -> Dict[str, Any]:
+    return coupon_cache_stats()
+
+@app.get("/metrics/expiry")
+async def expiry_metrics() -> Dict[str, Any]:
+    return expiry_stats()
+
+@app.get("/metrics/idempotency")
+async def idempotency_metrics() -> Dict[str, Any]:
+    return idempotency_stats()
+
+@app.get("/metrics/archive")
+async def archive_metrics() -> Dict[str, Any]:
+    return archive_stats()
+
+@app.get("/metrics/db-executor")
+async def db_executor_metrics() -> Dict[str, Any]:
+    return db.stats()
+
+# Операторы с наибольшим суммарным временем (при SQL_TRACE=1)
+@app.get("/metrics/sql")
+async def sql_metrics(limit: int = 50) -> Dict[str, Any]:
+    return {'enabled': sqltrace.SQL_TRACE, 'slow_ms': sqltrace.SQL_SLOW_MS,
+            'statements': sqltrace.statement_stats(limit)}
+
+@app.get("/metrics/group-commit")
+async def group_commit_metrics() -> Dict[str, Any]:
+    writer = referral_system.purchase_writer
+    return writer.stats() if writer is not None else {'enabled': False}
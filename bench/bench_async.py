@@ -0,0 +1,93 @@
+"""p50/p99 латентность /invite, /purchase и проверки купона при 500 одновременных клиентах.
+
+    python bench/bench_async.py [--clients 500] [--requests 10] [--pool-size 8]
+    python bench/bench_async.py --url http://127.0.0.1:8000   # против запущенного uvicorn
+
+Без --url приложение гоняется в процессе через httpx.ASGITransport на временной базе.
+Admission control при этом выключен (RATE_LIMIT=0); сервер для --url запускайте
+с RATE_LIMIT=0, иначе клиенты упрутся в 429.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# Меряем пропускную способность, а не лимиты: admission control выключен
+# до импорта app. RATE_LIMIT=1 включает его обратно.
+os.environ.setdefault('RATE_LIMIT', '0')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def client(http, n, latencies, client_id):
+    for i in range(n):
+        t0 = time.perf_counter()
+        r = await http.post('/invite', data={
+            'inviter_id': f'c{client_id}', 'invited_id': f'c{client_id}-{i}',
+            'invited_discount': 10, 'inviter_reward': 5,
+        })
+        latencies['invite'].append(time.perf_counter() - t0)
+        r.raise_for_status()
+
+        t0 = time.perf_counter()
+        r = await http.get('/coupon/ZZZZZ', params={'buyer_id': f'c{client_id}'})
+        latencies['validate'].append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        r = await http.post('/purchase', data={'buyer_id': f'c{client_id}-{i}'})
+        latencies['purchase'].append(time.perf_counter() - t0)
+        r.raise_for_status()
+
+
+async def run(args):
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        import app
+        app.db.workers = args.pool_size
+        transport = httpx.ASGITransport(app=app.app)
+        base_url = 'http://bench'
+
+    latencies = {'invite': [], 'validate': [], 'purchase': []}
+    limits = httpx.Limits(max_connections=args.clients)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url,
+                                 limits=limits, timeout=60) as http:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(http, args.requests, latencies, c)
+                               for c in range(args.clients)))
+        elapsed = time.perf_counter() - t0
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"{args.clients} clients, {total} requests in {elapsed:.1f}s ({total / elapsed:,.0f} req/s)")
+    for route, values in latencies.items():
+        print(f"  {route:9} p50 {percentile(values, 0.50) * 1000:7.1f} ms"
+              f"   p99 {percentile(values, 0.99) * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--url')
+    args = parser.parse_args()
+
+    if args.url:
+        asyncio.run(run(args))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
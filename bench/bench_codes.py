@@ -0,0 +1,61 @@
+"""Выделение кодов купонов пачками против старого gen_code() по символу.
+
+    python bench/bench_codes.py [--total 2000000] [--batch 10000] [--length 5]
+
+Выделенные коды сразу вставляются в coupons, так что по мере заполнения
+таблицы растет и число коллизий, как в боевой базе.
+"""
+import argparse
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+
+
+def legacy_gen_code(length):
+    return ''.join(secrets.choice(rs.ALPHABET) for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--total', type=int, default=2_000_000)
+    parser.add_argument('--batch', type=int, default=10_000)
+    parser.add_argument('--length', type=int, default=rs.CODE_LENGTH)
+    args = parser.parse_args()
+
+    n = min(args.total, 200_000)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        legacy_gen_code(args.length)
+    legacy = n / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    rs.gen_codes(n, args.length)
+    batched = n / (time.perf_counter() - t0)
+    print(f"generate only: secrets.choice {legacy:,.0f} codes/s, gen_codes {batched:,.0f} codes/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rs.DB = os.path.join(tmp, 'bench.db')
+        rs.init_db()
+        allocated = 0
+        t0 = time.perf_counter()
+        while allocated < args.total:
+            size = min(args.batch, args.total - allocated)
+            with rs.transaction() as cur:
+                codes = rs.allocate_codes(size, args.length, conn=cur)
+                cur.executemany("INSERT INTO coupons(code) VALUES (?)", ((c,) for c in codes))
+            allocated += size
+        elapsed = time.perf_counter() - t0
+        space = len(rs.ALPHABET) ** args.length
+        print(f"allocate+insert {allocated:,} codes (length {args.length}, "
+              f"{allocated / space:.1%} of code space): {allocated / elapsed:,.0f} codes/s")
+        rs.close_conn()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Сравнение connect-per-call и пула соединений на путях /invite и /purchase.
+
+    python bench/bench_connections.py [--n 300]
+
+"before" — новое соединение без PRAGMA на каждый вызов get_conn(), предыдущее
+закрывается. После объединения start_invite и complete_purchase в одну транзакцию
+(user-002) это одно соединение на операцию, а не пять на инвайт, как в исходном
+коде, где каждая функция делала sqlite3.connect(DB); бенчмарк меряет цену
+connect-per-call против пула на текущем коде, а не старую версию целиком.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+
+
+def run(n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        rs.start_invite(f'a{i}', f'b{i}', 10, 5, 'alice', 'bob')
+    invite_rps = n / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        rs.complete_purchase(f'b{i}', 1)
+    purchase_rps = n / (time.perf_counter() - t0)
+    return invite_rps, purchase_rps
+
+
+# Соединение на каждый вызов; прошлое закрываем, чтобы не копить открытые файлы
+class ConnectPerCall:
+    def __init__(self):
+        self.conn = None
+
+    def __call__(self):
+        self.close()
+        self.conn = sqlite3.connect(rs.DB)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=300)
+    args = parser.parse_args()
+
+    pooled_get_conn = rs.get_conn
+    results = {}
+    per_call = ConnectPerCall()
+    for label, get_conn in (('before', per_call), ('after', pooled_get_conn)):
+        with tempfile.TemporaryDirectory() as tmp:
+            rs.DB = os.path.join(tmp, 'bench.db')
+            rs.get_conn = get_conn
+            rs.init_db()
+            results[label] = run(args.n)
+            per_call.close()
+            rs.close_conn()
+
+    print(f"{'':8}{'invite req/s':>14}{'purchase req/s':>16}")
+    for label, (invite_rps, purchase_rps) in results.items():
+        print(f"{label:8}{invite_rps:14.0f}{purchase_rps:16.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Пропускная способность записи покупок: отдельный commit на покупку против group commit.
+
+    python bench/bench_group_commit.py [--threads 32] [--n 200] [--synchronous FULL]
+
+--synchronous задает PRAGMA synchronous (NORMAL по умолчанию, как в боевом пуле;
+при FULL каждый commit — это fsync, и разница видна сильнее всего).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+
+
+def run(threads, n, grouped):
+    def worker(t):
+        for i in range(n):
+            if grouped:
+                rs.submit_purchase(f'buyer{t}', 1).result()
+            else:
+                rs.complete_purchase(f'buyer{t}', 1)
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    t0 = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return threads * n / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--n', type=int, default=200)
+    parser.add_argument('--synchronous', default='NORMAL')
+    args = parser.parse_args()
+
+    rs.PRAGMAS = tuple(p for p in rs.PRAGMAS if 'synchronous' not in p) + (
+        f"PRAGMA synchronous={args.synchronous}",)
+    for label, grouped in (('commit per purchase', False), ('group commit', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            rs.DB = os.path.join(tmp, 'bench.db')
+            rs.init_db()
+            if grouped:
+                writer = rs.start_group_commit()
+            rps = run(args.threads, args.n, grouped)
+            if grouped:
+                stats = writer.stats()
+                rs.stop_group_commit()
+                label += f" ({stats['items_per_commit']:.1f} purchases/commit)"
+            print(f"{label:45} {rps:10,.0f} purchases/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Импорт рефералов: start_invite по одному против import_invites пачками.
+
+    python bench/bench_import.py [--n 100000] [--chunk-size 1000] [--single 2000]
+
+start_invite меряется на --single строках (на 100k он слишком долгий),
+пачки — на всех --n.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+from importer import import_invites
+
+
+def rows(n):
+    for i in range(n):
+        yield i + 1, {'inviter_id': f'p{i % 5000}', 'invited_id': f'q{i}',
+                      'invited_discount': 10, 'inviter_reward': 5}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--single', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rs.DB = os.path.join(tmp, 'single.db')
+        rs.init_db()
+        t0 = time.perf_counter()
+        for _, row in rows(args.single):
+            rs.start_invite(row['inviter_id'], row['invited_id'],
+                            row['invited_discount'], row['inviter_reward'])
+        single_rps = args.single / (time.perf_counter() - t0)
+        rs.close_conn()
+
+        rs.DB = os.path.join(tmp, 'batch.db')
+        rs.init_db()
+        t0 = time.perf_counter()
+        report = import_invites(rows(args.n), chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - t0
+        rs.close_conn()
+
+    print(f"start_invite     {single_rps:10,.0f} referrals/s  (~{args.n / single_rps:.0f}s for {args.n:,})")
+    print(f"import_invites   {report.imported / elapsed:10,.0f} referrals/s  "
+          f"({report.imported:,} in {elapsed:.1f}s, {report.failed} failed)")
+
+
+if __name__ == '__main__':
+    main()
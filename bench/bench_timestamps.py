@@ -0,0 +1,145 @@
+"""ISO-8601 TEXT против INTEGER epoch-секунд на таблице купонов в 1M строк.
+
+    python bench/bench_timestamps.py [--rows 1000000] [--samples 2000]
+
+Строит базу в старом формате (схема версии 0), меряет страницу дашборда,
+диапазонный запрос по expires_at, погашение купона и размер файла, затем
+мигрирует ее через init_db() и повторяет замеры.
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+
+BASE_TS = 1_700_000_000
+
+
+def legacy_ddl(table):
+    ddl = rs.TABLES[table]
+    for column in rs.TIMESTAMP_COLUMNS.get(table, ()):
+        ddl = ddl.replace(f"{column} INTEGER", f"{column} TEXT")
+    return ddl
+
+
+def build_legacy(rows):
+    conn = rs.get_conn()
+    with rs.transaction() as cur:
+        for table in rs.TABLES:
+            cur.execute(legacy_ddl(table))
+        cur.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+            INSERT INTO users(tg_id, tg_username, created_at)
+            SELECT 'u' || i, 'user' || i, strftime('%Y-%m-%dT%H:%M:%f', ?, 'unixepoch') || '000'
+            FROM n
+        """, (rows // 100, BASE_TS))
+        cur.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1)
+            INSERT INTO coupons(code, coupon_type, discount_percent, stars_count, min_stars,
+                                owner_tg_id, inviter_tg_id, invited_tg_id, status,
+                                created_at, expires_at)
+            SELECT printf('C%07d', i), 'invited_discount', 10, 10, 10,
+                   'u' || (i % ?), 'u0', 'u' || (i % ?), 'active',
+                   strftime('%Y-%m-%dT%H:%M:%f', ? + i, 'unixepoch') || '000',
+                   strftime('%Y-%m-%dT%H:%M:%f', ? + i + 30 * 86400, 'unixepoch') || '000'
+            FROM n
+        """, (rows, rows // 100, rows // 100, BASE_TS, BASE_TS))
+    # Индексы — как у старой версии init_db
+    with rs.transaction() as cur:
+        for ddl in rs.INDEXES:
+            cur.execute(ddl)
+    conn.execute("ANALYZE")
+
+
+def db_size():
+    rs.get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(os.path.getsize(rs.DB + suffix) for suffix in ('', '-wal')
+               if os.path.exists(rs.DB + suffix))
+
+
+def timed(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - t0) / n * 1e6  # мкс на вызов
+
+
+def measure(to_ts, format_ts, rows, samples, offset):
+    conn = rs.get_conn()
+    mid = to_ts(BASE_TS + rows // 2)
+    results = {}
+
+    def deep_page(i):
+        page = conn.execute(rs.LIST_COUPONS_BEFORE_SQL, (mid, 'C9999999', rs.PAGE_SIZE)).fetchall()
+        for row in page:
+            format_ts(row[12]), format_ts(row[13]), format_ts(row[14])
+    results['dashboard page'] = timed(deep_page, 200)
+
+    def expiring(i):
+        conn.execute("SELECT count(*) FROM coupons WHERE expires_at <= ?",
+                     (to_ts(BASE_TS + 30 * 86400 + 10_000),)).fetchone()
+    results['expires_at range'] = timed(expiring, 200)
+
+    def redeem(i):
+        n = offset + i
+        ts = to_ts(BASE_TS + n)
+        with rs.transaction() as cur:
+            cur.execute(rs.REDEEM_COUPON_SQL,
+                        (ts, f'C{n:07d}', f'u{n % (rows // 100)}', ts)).fetchone()
+    results['redeem'] = timed(redeem, samples)
+    return results
+
+
+def iso(ts):
+    # Как писал старый now().isoformat(): наивное UTC с микросекундами
+    dt = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None)
+    return dt.isoformat(timespec='microseconds')
+
+
+def format_iso(value):
+    return datetime.datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S") if value else "-"
+
+
+def format_epoch(value):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(value)) if value else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rs.DB = os.path.join(tmp, 'bench.db')
+        t0 = time.perf_counter()
+        build_legacy(args.rows)
+        print(f"built {args.rows:,} legacy coupons in {time.perf_counter() - t0:.1f}s")
+
+        before = measure(iso, format_iso, args.rows, args.samples, 0)
+        before['db size, MB'] = db_size() / 2**20
+
+        t0 = time.perf_counter()
+        rs.init_db()
+        migrated = time.perf_counter() - t0
+        rs.get_conn().execute("VACUUM")
+        rs.get_conn().execute("ANALYZE")
+        print(f"migrated in {migrated:.1f}s")
+
+        after = measure(lambda ts: ts, format_epoch, args.rows, args.samples, args.samples)
+        after['db size, MB'] = db_size() / 2**20
+        rs.close_conn()
+
+    print(f"{'':20}{'TEXT':>12}{'INTEGER':>12}")
+    for key in before:
+        unit = '' if 'MB' in key else ' µs'
+        print(f"{key:20}{before[key]:12.1f}{after[key]:12.1f}{unit}")
+
+
+if __name__ == '__main__':
+    main()
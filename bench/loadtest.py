@@ -0,0 +1,300 @@
+"""Нагрузочный прогон /invite, /purchase, дашборда и DELETE /coupon/{code} со сравнением с baseline.
+
+    python bench/loadtest.py seed --db referral.db [--users 10000] [--referrals 10000]
+    python bench/loadtest.py run [--driver asgi|uvicorn] [--requests 2000] [--concurrency 50]
+                                 [--save-baseline bench/baseline.json]
+                                 [--baseline bench/baseline.json] [--threshold 0.2]
+
+run сидирует временную базу и гоняет сценарии через httpx.ASGITransport
+(--driver asgi, по умолчанию) или через локальный uvicorn в отдельном процессе
+(--driver uvicorn). Отчет — req/s, p50/p95/p99 по сценарию и размер базы.
+С --baseline выходит с кодом 1, если req/s какого-то сценария упал или p95
+вырос больше чем на --threshold (доля). Baseline машинно-зависим, поэтому
+в репозиторий не коммитится: его сохраняют на той же машине через --save-baseline.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+# Меряем пропускную способность, а не лимиты: admission control выключен
+# (и для uvicorn — через окружение процесса). RATE_LIMIT=1 включает его обратно.
+os.environ.setdefault('RATE_LIMIT', '0')
+
+import referral_system as rs
+
+SCENARIOS = ('invite', 'purchase', 'dashboard', 'delete')
+
+
+# --- seed ---
+# Реферал i: пригласивший u<i % users>, приглашенный n<i>, купоны I<i> (у n<i>)
+# и R<i> (у пригласившего). Прогон тратит эти купоны по порядку.
+def seed(path, users, referrals):
+    rs.DB = path
+    rs.init_db()
+    ts = rs.now_ts()
+    with rs.transaction() as cur:
+        cur.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1)
+            INSERT INTO users(tg_id, tg_username, total_invites, created_at)
+            SELECT 'u' || i, 'user' || i, 0, ? - i FROM n
+        """, (users, ts))
+        cur.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1)
+            INSERT INTO users(tg_id, tg_username, created_at)
+            SELECT 'n' || i, NULL, ? - i FROM n
+        """, (referrals, ts))
+        for prefix, ctype, discount, stars, owner in (
+                ('I', 'invited_discount', 10, 10, "'n' || i"),
+                ('R', 'inviter_reward', 5, 1, "'u' || (i % :users)")):
+            cur.execute(f"""
+                WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < :refs - 1)
+                INSERT INTO coupons(code, coupon_type, discount_percent, stars_count, min_stars,
+                                    owner_tg_id, inviter_tg_id, invited_tg_id, status,
+                                    created_at, expires_at)
+                SELECT printf('{prefix}%07d', i), '{ctype}', {discount}, {stars}, {stars},
+                       {owner}, 'u' || (i % :users), 'n' || i, 'active',
+                       :ts - i, :ts - i + 30 * 86400
+                FROM n
+            """, {'refs': referrals, 'users': users, 'ts': ts})
+        cur.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < :refs - 1)
+            INSERT INTO referrals(inviter_tg_id, invited_tg_id, inviter_coupon_code,
+                                  invited_coupon_code, status, created_at)
+            SELECT 'u' || (i % :users), 'n' || i, printf('R%07d', i), printf('I%07d', i),
+                   'pending', :ts - i
+            FROM n
+        """, {'refs': referrals, 'users': users, 'ts': ts})
+        cur.execute("""
+            UPDATE users SET total_invites = (
+                SELECT count(*) FROM referrals WHERE inviter_tg_id = users.tg_id
+            ) WHERE tg_id LIKE 'u%'
+        """)
+        rs.rebuild_stats(cur)
+    rs.refill_code_pool()
+    rs.get_conn().execute("ANALYZE")
+    rs.get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    rs.close_conn()
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+# --- scenarios ---
+def scenario_request(name, i):
+    if name == 'invite':
+        return 'POST', '/invite', {'data': {
+            'inviter_id': f'u{i}', 'invited_id': f'lt{i}',
+            'invited_discount': 10, 'inviter_reward': 5}}
+    if name == 'purchase':
+        return 'POST', '/purchase', {'data': {'buyer_id': f'n{i}', 'coupon': f'I{i:07d}'}}
+    if name == 'dashboard':
+        # Первая страница и страница из середины по keyset-курсору
+        if i % 2:
+            return 'GET', '/', {}
+        return 'GET', '/', {'params': {'before': f'{rs.now_ts() - i}|R{i:07d}'}}
+    if name == 'delete':
+        return 'DELETE', f'/coupon/R{i:07d}', {}
+    raise ValueError(name)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_scenario(http, name, requests, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            method, url, kwargs = scenario_request(name, i)
+            t0 = time.perf_counter()
+            r = await http.request(method, url, **kwargs)
+            if name == 'dashboard':
+                await r.aread()
+            latencies.append(time.perf_counter() - t0)
+            if r.status_code >= 400:
+                errors += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': requests / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run_all(http, args):
+    return {name: await run_scenario(http, name, args.requests, args.concurrency)
+            for name in args.scenarios}
+
+
+# --- drivers ---
+async def drive_asgi(args):
+    import app
+    transport = httpx.ASGITransport(app=app.app)
+    async with app.app.router.lifespan_context(app.app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=60) as http:
+            return await run_all(http, args)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def drive_uvicorn(args):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(ROOT))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port),
+         '--log-level', 'warning', '--workers', str(args.workers)],
+        cwd=os.getcwd(), env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+            for _ in range(100):
+                try:
+                    await http.get('/stats')
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not start")
+            return await run_all(http, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# --- baseline ---
+def compare(report, baseline, threshold):
+    regressions = []
+    for name, result in report['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"{name}: {result['rps']:.0f} req/s < baseline {base['rps']:.0f}")
+        if result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f} ms > baseline {base['p95_ms']:.1f}")
+    return regressions
+
+
+def print_report(report):
+    print(f"driver={report['driver']} concurrency={report['concurrency']} "
+          f"db {report['db_size_mb']['before']:.1f} -> {report['db_size_mb']['after']:.1f} MB, "
+          f"wal {report['db_size_mb']['wal']:.1f} MB")
+    print(f"{'':10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, r in report['scenarios'].items():
+        print(f"{name:10}{r['rps']:10.0f}{r['p50_ms']:10.1f}{r['p95_ms']:10.1f}"
+              f"{r['p99_ms']:10.1f}{r['errors']:8}")
+
+
+def cmd_seed(args):
+    t0 = time.perf_counter()
+    seed(args.db, args.users, args.referrals)
+    print(f"seeded {args.db} in {time.perf_counter() - t0:.1f}s, {file_size(args.db) / 2**20:.1f} MB")
+    return 0
+
+
+def cmd_run(args):
+    if args.requests > args.referrals:
+        sys.exit("--requests must not exceed --referrals: each request spends its own seeded coupon")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        path = os.path.join(tmp, rs.DB)
+        seed(path, args.users, args.referrals)
+        size_before = file_size(path)
+        drive = drive_asgi if args.driver == 'asgi' else drive_uvicorn
+        scenarios = asyncio.run(drive(args))
+        # WAL отдельно: при непрерывной нагрузке checkpoint не успевает его сбросить
+        wal_size = file_size(path + '-wal')
+        size_after = file_size(path)
+        rs.close_conn()
+        os.chdir(ROOT)
+
+    report = {
+        'driver': args.driver,
+        'concurrency': args.concurrency,
+        'users': args.users,
+        'referrals': args.referrals,
+        'scenarios': scenarios,
+        'db_size_mb': {'before': size_before / 2**20, 'after': size_after / 2**20,
+                       'wal': wal_size / 2**20},
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('driver') != report['driver']:
+            print(f"warning: baseline driver is {baseline.get('driver')}", file=sys.stderr)
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+        print(f"no regressions over {args.threshold:.0%}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def add_seed_args(p):
+        p.add_argument('--users', type=int, default=10000)
+        p.add_argument('--referrals', type=int, default=10000)
+
+    p = sub.add_parser('seed', help="наполнить базу пользователями, купонами и рефералами")
+    p.add_argument('--db', default=rs.DB)
+    add_seed_args(p)
+    p.set_defaults(func=cmd_seed)
+
+    p = sub.add_parser('run', help="прогнать сценарии на свежей временной базе")
+    add_seed_args(p)
+    p.add_argument('--driver', choices=('asgi', 'uvicorn'), default='asgi')
+    p.add_argument('--workers', type=int, default=1, help="воркеры uvicorn для --driver uvicorn")
+    p.add_argument('--requests', type=int, default=2000, help="запросов на сценарий")
+    p.add_argument('--concurrency', type=int, default=50)
+    p.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    p.add_argument('--json', help="записать отчет в файл")
+    p.add_argument('--save-baseline')
+    p.add_argument('--baseline')
+    p.add_argument('--threshold', type=float, default=0.2)
+    p.set_defaults(func=cmd_run)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+# Отдельный пул потоков для работы с SQLite вместо общего threadpool Starlette.
+# У каждого потока пула свое соединение (referral_system.get_conn), так что
+# размер пула — это и число соединений воркера. Очередь ограничена: когда
+# в ней больше DB_QUEUE_DEPTH задач, новые запросы сразу получают DBBusy,
+# а не копятся, пока не истечет таймаут клиента.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_QUEUE_DEPTH = int(os.environ.get('DB_QUEUE_DEPTH', 512))
+
+
+class DBBusy(Exception):
+    pass
+
+
+class DBExecutor:
+    def __init__(self, workers: int = DB_POOL_SIZE, queue_depth: int = DB_QUEUE_DEPTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._pool = None  # создается при первом запросе и заново после shutdown()
+        self._lock = threading.Lock()
+        self.pending = 0  # в очереди + выполняются; меняется только из event loop
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        if self.pending >= self.workers + self.queue_depth:
+            self.rejected += 1
+            raise DBBusy(f"DB queue is full ({self.queue_depth})")
+        # contextvars запроса (трассировка и т.п.) видны и в потоке пула
+        ctx = contextvars.copy_context()
+        submitted = time.perf_counter()
+
+        def call():
+            waited = time.perf_counter() - submitted
+            with self._lock:
+                self.running += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            try:
+                return ctx.run(fn, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='db')
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, call)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = self.running
+            completed = self.completed
+            wait_total = self.wait_seconds_total
+            wait_max = self.wait_seconds_max
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queue_depth,
+            'running': running,
+            'queued': max(self.pending - running, 0),
+            'completed': completed,
+            'rejected': self.rejected,
+            'wait_seconds_avg': wait_total / completed if completed else 0.0,
+            'wait_seconds_max': wait_max,
+        }
+
+
+db = DBExecutor()
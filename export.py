@@ -0,0 +1,88 @@
+import csv
+import datetime
+import io
+import json
+import zlib
+from typing import Iterator, List, Optional
+
+from referral_system import EXPORT_CHUNK, EXPORT_TABLES, export_rows
+
+# Кодирование выгрузки по кускам: CSV или NDJSON, по желанию сразу в gzip.
+# Общий код для /export/{table} и manage.py export; куски строк приходят
+# из referral_system.export_chunk / export_rows.
+EXPORT_FORMATS = {
+    'csv': "text/csv; charset=utf-8",
+    'ndjson': "application/x-ndjson",
+}
+
+TIMESTAMP_FIELDS = ('created_at', 'expires_at', 'used_at', 'completed_at')
+
+def format_ts(value: Optional[int]) -> Optional[str]:
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# "2024-05-01" или "2024-05-01T12:00:00[+03:00]" -> epoch-секунды; без зоны — UTC
+def parse_date(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+class ExportEncoder:
+    def __init__(self, table: str, fmt: str = 'csv', gzip: bool = False):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"unknown format: {fmt}")
+        self.columns = EXPORT_TABLES[table][0]
+        self.fmt = fmt
+        self.gzip = gzip
+        self.filename = f"{table}.{fmt}" + ('.gz' if gzip else '')
+        self.media_type = 'application/gzip' if gzip else EXPORT_FORMATS[fmt]
+        self._ts_indexes = [i for i, c in enumerate(self.columns) if c in TIMESTAMP_FIELDS]
+        # wbits=31 — gzip-обертка, поток можно сохранить как .gz
+        self._zlib = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer, lineterminator='\n')
+
+    def _out(self, text: str) -> bytes:
+        data = text.encode('utf-8')
+        return self._zlib.compress(data) if self._zlib else data
+
+    def header(self) -> bytes:
+        return self._out(','.join(self.columns) + '\n') if self.fmt == 'csv' else b''
+
+    def rows(self, rows: List[tuple]) -> bytes:
+        if self._ts_indexes:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in self._ts_indexes:
+                    row[i] = format_ts(row[i])
+        if self.fmt == 'csv':
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            self._csv.writerows(rows)
+            text = self._buffer.getvalue()
+        else:
+            text = ''.join(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n'
+                           for row in rows)
+        return self._out(text)
+
+    def finish(self) -> bytes:
+        return self._zlib.flush() if self._zlib else b''
+
+
+# Синхронная выгрузка (CLI): куски байт, память — один кусок строк
+def iter_export(table: str, fmt: str = 'csv', gzip: bool = False,
+                since: Optional[int] = None, until: Optional[int] = None,
+                status: Optional[str] = None, chunk_size: int = EXPORT_CHUNK,
+                include_archived: bool = True) -> Iterator[bytes]:
+    encoder = ExportEncoder(table, fmt, gzip)
+    yield encoder.header()
+    for rows in export_rows(table, since, until, status, chunk_size, include_archived):
+        data = encoder.rows(rows)
+        if data:
+            yield data
+    yield encoder.finish()
@@ -0,0 +1,87 @@
+import csv
+import json
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from referral_system import IMPORT_CHUNK, import_invites_chunk
+
+# Чтение входных данных импорта рефералов (NDJSON, CSV, JSON-массив) и сбор
+# итога. Общий код для POST /invites/batch и manage.py import-invites; запись
+# пачек — referral_system.import_invites_chunk.
+IMPORT_MAX_ERRORS = 1000  # в отчете; failed считает все
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def add(self, result: Dict[str, Any]):
+        self.imported += result['imported']
+        for error in result['errors']:
+            self.error(error['line'], error['error'])
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+# Разобранная строка или None (ошибка уже записана в отчет); пустые строки пропускаются
+def parse_ndjson_line(line_no: int, line, report: ImportReport) -> Optional[Tuple[int, Any]]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return line_no, json.loads(line)
+    except ValueError as e:
+        report.error(line_no, f"invalid JSON: {e}")
+        return None
+
+def iter_ndjson(lines: Iterable, report: ImportReport) -> Iterator[Tuple[int, Any]]:
+    for line_no, line in enumerate(lines, 1):
+        row = parse_ndjson_line(line_no, line, report)
+        if row is not None:
+            yield row
+
+# Первая строка — заголовок с полями формы /invite; номер строки — как в файле
+def iter_csv(lines: Iterable[str]) -> Iterator[Tuple[int, Dict[str, str]]]:
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+def chunks(rows: Iterable[Tuple[int, Any]], size: int = IMPORT_CHUNK) -> Iterator[List[Tuple[int, Any]]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Тело запроса по строкам, не дожидаясь его целиком
+async def aiter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = b''
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+def import_invites(rows: Iterable[Tuple[int, Any]], report: Optional[ImportReport] = None,
+                   chunk_size: int = IMPORT_CHUNK) -> ImportReport:
+    report = report or ImportReport()
+    for chunk in chunks(rows, chunk_size):
+        report.add(import_invites_chunk(chunk))
+    return report
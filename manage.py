@@ -0,0 +1,129 @@
+import argparse
+import json
+import sys
+
+import referral_system as rs
+
+
+def cmd_check_plans(args):
+    rs.init_db()
+    problems = rs.check_query_plans()
+    for problem in problems:
+        print(problem)
+    if problems:
+        return 1
+    print(f"{len(rs.QUERY_PLANS)} query plans OK")
+    return 0
+
+
+def cmd_migrate(args):
+    before = rs.schema_version(rs.get_conn())
+    rs.init_db()
+    after = rs.schema_version(rs.get_conn())
+    print(f"schema version {before} -> {after}")
+    if args.vacuum:
+        # После пересоздания таблиц старые страницы остаются в файле свободными.
+        # Заодно переводит старые базы в auto_vacuum=INCREMENTAL (PRAGMA соединения
+        # задает режим, но у существующего файла он меняется только после VACUUM).
+        conn = rs.get_conn()
+        conn.execute("VACUUM")
+        print(f"vacuumed, auto_vacuum={conn.execute('PRAGMA auto_vacuum').fetchone()[0]}")
+    return 0
+
+
+def cmd_rebuild_stats(args):
+    rs.init_db()
+    before = rs.read_stats()
+    rs.rebuild_stats()
+    after = rs.read_stats()
+    print(json.dumps(after, indent=2, ensure_ascii=False))
+    if before != after:
+        print("stats were out of sync and have been rebuilt", file=sys.stderr)
+    return 0
+
+
+def cmd_archive(args):
+    rs.init_db()
+    result = rs.archive_old_rows(args.retention_days, args.batch, vacuum=not args.no_vacuum)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+def cmd_export(args):
+    from export import iter_export, parse_date
+    rs.init_db()
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for data in iter_export(args.table, args.format, args.gzip, parse_date(args.since),
+                                parse_date(args.until), args.status, args.chunk_size,
+                                not args.hot_only):
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+def cmd_import_invites(args):
+    from importer import ImportReport, import_invites, iter_csv, iter_ndjson
+    rs.init_db()
+    fmt = args.format or ('csv' if args.file.endswith('.csv') else 'ndjson')
+    f = open(args.file, encoding='utf-8', newline='') if args.file != '-' else sys.stdin
+    try:
+        report = ImportReport()
+        rows = iter_csv(f) if fmt == 'csv' else iter_ndjson(f, report)
+        import_invites(rows, report, args.chunk_size)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    print(json.dumps(report.as_dict(), indent=2, ensure_ascii=False))
+    return 1 if report.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Referral DB maintenance")
+    parser.add_argument('--db', default=rs.DB, help="путь к базе (по умолчанию %(default)s)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('check-plans', help="проверить EXPLAIN QUERY PLAN горячих запросов")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser('migrate', help="обновить схему базы до текущей версии")
+    p.add_argument('--vacuum', action='store_true', help="после миграции сжать файл базы")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser('rebuild-stats', help="пересчитать таблицу stats из coupons/referrals/purchases")
+    p.set_defaults(func=cmd_rebuild_stats)
+
+    p = sub.add_parser('archive', help="перенести старые used/expired купоны и completed рефералы в архив")
+    p.add_argument('--retention-days', type=float, default=rs.ARCHIVE_RETENTION_DAYS)
+    p.add_argument('--batch', type=int, default=rs.ARCHIVE_BATCH)
+    p.add_argument('--no-vacuum', action='store_true', help="не делать incremental vacuum")
+    p.set_defaults(func=cmd_archive)
+
+    p = sub.add_parser('export', help="выгрузить таблицу в CSV/NDJSON (потоково, кусками)")
+    p.add_argument('table', choices=list(rs.EXPORT_TABLES))
+    p.add_argument('--format', choices=('csv', 'ndjson'), default='csv')
+    p.add_argument('--gzip', action='store_true')
+    p.add_argument('--since', help="created_at >= (ISO-8601, без зоны — UTC)")
+    p.add_argument('--until', help="created_at < (ISO-8601, без зоны — UTC)")
+    p.add_argument('--status')
+    p.add_argument('--chunk-size', type=int, default=rs.EXPORT_CHUNK)
+    p.add_argument('--hot-only', action='store_true', help="без строк, перенесенных в архив")
+    p.add_argument('-o', '--output', help="файл (по умолчанию stdout)")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('import-invites', help="импорт рефералов из CSV/NDJSON пачками")
+    p.add_argument('file', help="файл или - для stdin; CSV с заголовком inviter_id,invited_id,"
+                                "invited_discount,inviter_reward[,inviter_username,invited_username]")
+    p.add_argument('--format', choices=('csv', 'ndjson'), help="по умолчанию — по расширению файла")
+    p.add_argument('--chunk-size', type=int, default=rs.IMPORT_CHUNK)
+    p.set_defaults(func=cmd_import_invites)
+
+    args = parser.parse_args(argv)
+    rs.DB = args.db
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import bisect
+import functools
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей.
+# Значения живут в памяти процесса (у каждого воркера uvicorn свои), запись —
+# словарь под блокировкой и perf_counter, так что сбор можно не выключать.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин в секундах: от долей миллисекунды (commit, кэш) до секунд
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List['Metric'] = []
+
+# (имя, метки, значение) — разовые значения, которые передаются в render()
+Sample = Tuple[str, Dict[str, Any], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(labels.get(n, '') for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    # Значение попадает в одну корзину; накопленные суммы считаются при выводе
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted((key, ([*counts], total, count))
+                           for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float('inf')), counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+# --- функции ---
+FUNCTION_SECONDS = Histogram('referral_function_seconds',
+                             "Время выполнения функций referral_system", ('function',))
+FUNCTION_ERRORS = Counter('referral_function_errors_total',
+                          "Исключения из функций referral_system", ('function',))
+
+def timed(fn: Callable) -> Callable:
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            FUNCTION_ERRORS.inc(function=name)
+            raise
+        finally:
+            FUNCTION_SECONDS.observe(time.perf_counter() - started, function=name)
+    return wrapper
+
+
+# --- HTTP ---
+HTTP_SECONDS = Histogram('referral_http_request_seconds',
+                         "Время обработки HTTP-запроса до конца ответа",
+                         ('method', 'route', 'status'))
+HTTP_IN_FLIGHT = Gauge('referral_http_requests_in_flight', "HTTP-запросы в обработке")
+
+# ASGI-middleware: маршрут берется из шаблона пути (/coupon/{code}), а не из URL,
+# чтобы число рядов не росло с числом кодов.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get('route')
+            HTTP_SECONDS.observe(time.perf_counter() - started, method=scope['method'],
+                                 route=getattr(route, 'path', 'unmatched'), status=status)
+
+
+# --- вывод ---
+# Плоский словарь статистики (stats() воркеров, кэшей, пулов) -> gauge-значения
+def flat_samples(prefix: str, values: Dict[str, Any],
+                 labels: Optional[Dict[str, Any]] = None) -> List[Sample]:
+    return [(f"{prefix}_{key}", labels or {}, float(value)) for key, value in values.items()
+            if isinstance(value, (int, float))]
+
+def render(samples: Iterable[Sample] = ()) -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    typed = set()
+    # Ряды одной метрики в выводе должны идти подряд
+    for name, labels, value in sorted(samples, key=lambda sample: sample[0]):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+    return '\n'.join(lines) + '\n'
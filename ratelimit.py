@@ -0,0 +1,130 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict
+
+import metrics
+
+# Допуск запросов в процессе по token bucket: на каждого пользователя и общий
+# на эндпоинт. Ведро пополняется rate токенами в секунду до burst; запрос берет
+# один токен, без токена — 429 с Retry-After. Срабатывает до обращения к базе,
+# поэтому один клиент не может занять блокировку записи для всех.
+# Лимиты свои у каждого воркера uvicorn. RATE_LIMIT=0 выключает все.
+RATE_LIMIT = os.environ.get('RATE_LIMIT', '1') == '1'
+# Сколько пользователей помним на эндпоинт; сверх — вытесняются самые давние
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float, scope: str):
+        super().__init__(f"rate limited ({scope}), retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+        self.scope = scope
+
+    # Retry-After — целые секунды, не меньше 1
+    def header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# Ведра по ключу: key -> (tokens, updated), порядок — от давно не использованных.
+# Ведро, простоявшее burst / rate секунд, снова полное и ничем не отличается от
+# нового, поэтому такие ключи удаляются; maxsize ограничивает память при наплыве
+# новых ключей. rate <= 0 — без ограничения.
+class TokenBuckets:
+    def __init__(self, rate: float, burst: float, maxsize: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.maxsize = maxsize
+        self.idle = self.burst / rate if rate > 0 else 0.0
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    # 0 — токен взят, иначе через сколько секунд он появится
+    def acquire(self, key: str = '') -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+            return wait
+
+    # Вернуть токен, если запрос не прошел следующий уровень
+    def refund(self, key: str = ''):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets[key] = (min(self.burst, bucket[0] + 1), bucket[1])
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, (_, updated) = next(iter(buckets.items()))
+            if len(buckets) <= self.maxsize and now - updated < self.idle:
+                return
+            del buckets[key]
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'keys': len(self._buckets), 'maxsize': self.maxsize, 'evictions': self.evictions}
+
+
+ADMITTED = metrics.Counter('referral_admission_admitted_total',
+                           "Запросы, прошедшие admission control", ('endpoint',))
+REJECTED = metrics.Counter('referral_admission_rejected_total',
+                           "Запросы, отклоненные admission control с 429", ('endpoint', 'scope'))
+
+
+# Ведро пользователя и общее ведро эндпоинта. Лимиты из окружения:
+# <NAME>_RATE_PER_USER / <NAME>_BURST_PER_USER и <NAME>_RATE_GLOBAL / <NAME>_BURST_GLOBAL.
+class Admission:
+    def __init__(self, name: str, rate_per_user: float, burst_per_user: float,
+                 rate_global: float, burst_global: float, enabled: bool = RATE_LIMIT):
+        env = name.upper()
+        self.name = name
+        self.enabled = enabled
+        self.users = TokenBuckets(_env_float(f'{env}_RATE_PER_USER', rate_per_user),
+                                  _env_float(f'{env}_BURST_PER_USER', burst_per_user))
+        self.total = TokenBuckets(_env_float(f'{env}_RATE_GLOBAL', rate_global),
+                                  _env_float(f'{env}_BURST_GLOBAL', burst_global), maxsize=1)
+
+    def check(self, user: str):
+        if not self.enabled:
+            return
+        wait = self.users.acquire(user)
+        if wait:
+            REJECTED.inc(endpoint=self.name, scope='user')
+            raise RateLimited(wait, 'user')
+        wait = self.total.acquire()
+        if wait:
+            self.users.refund(user)
+            REJECTED.inc(endpoint=self.name, scope='global')
+            raise RateLimited(wait, 'global')
+        ADMITTED.inc(endpoint=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        users = self.users.stats()
+        return {'enabled': int(self.enabled), 'user_keys': users['keys'],
+                'user_keys_max': users['maxsize'], 'user_evictions': users['evictions']}
+
+
+# Инвайт пишет больше строк и выделяет коды, поэтому на пользователя строже покупки
+invite_admission = Admission('invite', rate_per_user=1.0, burst_per_user=10,
+                             rate_global=200.0, burst_global=400)
+purchase_admission = Admission('purchase', rate_per_user=2.0, burst_per_user=10,
+                               rate_global=500.0, burst_global=1000)
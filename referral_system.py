@@ -1,283 +1,1903 @@
-import sqlite3
-import secrets
-import string
-import datetime
-import time
-from typing import Optional, Dict, Any
-
-__all__ = ['init_db', 'start_invite', 'complete_purchase', 'list_coupons', 'delete_coupon']
-
-DB = 'referral.db'
-
-# --- utils ---
-ALPHABET = ''.join([c for c in string.ascii_uppercase + string.digits if c not in "IO01"])
-
-def now():
-    return datetime.datetime.utcnow()
-
-def gen_code(length=5):
-    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
-
-# --- DB init (ИСПРАВЛЕНО: Одно закрытие соединения) ---
-def init_db():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    
-    # Таблица пользователей
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tg_id TEXT UNIQUE,
-        tg_username TEXT,
-        total_invites INTEGER DEFAULT 0,
-        total_purchases INTEGER DEFAULT 0,
-        created_at TEXT
-    )""")
-    
-    # Таблица купонов
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS coupons(
-        code TEXT PRIMARY KEY,
-        coupon_type TEXT,  -- 'invited_discount' или 'inviter_reward'
-        discount_percent INTEGER,  -- процент скидки
-        stars_count INTEGER,  -- количество звезд, на которое действует купон (для информации)
-        min_stars INTEGER DEFAULT 1,  -- минимальное количество звезд для применения купона
-        owner_tg_id TEXT,  -- владелец купона (tg_id)
-        inviter_tg_id TEXT,  -- кто пригласил
-        invited_tg_id TEXT,  -- кого пригласили
-        status TEXT,  -- 'active', 'used', 'expired'
-        created_at TEXT,
-        expires_at TEXT,
-        used_at TEXT
-    )""")
-    
-    # Таблица рефералов
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS referrals(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        inviter_tg_id TEXT,
-        invited_tg_id TEXT,
-        inviter_coupon_code TEXT,
-        invited_coupon_code TEXT,
-        status TEXT,
-        created_at TEXT,
-        completed_at TEXT
-    )""")
-    
-    # Таблица покупок (ПРОВЕРЕНО: содержит discount_percent)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS purchases(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        buyer_tg_id TEXT,
-        stars_count INTEGER,  -- количество купленных звезд
-        coupon_code TEXT,  -- использованный купон
-        discount_percent INTEGER, -- процент использованной скидки
-        created_at TEXT
-    )""")
-    
-    conn.commit()
-    conn.close()
-
-# --- user operations ---
-def create_user(tg_id, tg_username=None):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    
-    # Проверяем существует ли пользователь
-    cur.execute("SELECT tg_id FROM users WHERE tg_id = ?", (tg_id,))
-    existing_user = cur.fetchone()
-    
-    if not existing_user:
-        # Создаем нового пользователя
-        created = now().isoformat()
-        cur.execute("INSERT INTO users(tg_id, tg_username, created_at) VALUES(?,?,?)", 
-                    (tg_id, tg_username, created))
-    elif tg_username:
-        # Обновляем username если он предоставлен
-        cur.execute("UPDATE users SET tg_username = ? WHERE tg_id = ?", 
-                    (tg_username, tg_id))
-    
-    conn.commit()
-    conn.close()
-    return tg_id
-
-
-# --- coupon operations ---
-def create_coupon(coupon_type, discount_percent, stars_count, owner_tg_id=None, 
-                  inviter_tg_id=None, invited_tg_id=None, min_stars=1, days_valid=30):
-    code = gen_code()
-    created = now().isoformat()
-    expires = (now() + datetime.timedelta(days=days_valid)).isoformat()
-    
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO coupons(
-            code, coupon_type, discount_percent, stars_count, min_stars,
-            owner_tg_id, inviter_tg_id, invited_tg_id, status, created_at, expires_at
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
-    """, (code, coupon_type, discount_percent, stars_count, min_stars,
-          owner_tg_id, inviter_tg_id, invited_tg_id, 'active', created, expires))
-    conn.commit()
-    conn.close()
-    return code
-
-
-# --- invite and purchase flow ---
-def start_invite(inviter_tg_id, invited_tg_id, 
-                 invited_discount_percent: int, inviter_reward_percent: int,
-                 inviter_username=None, invited_username=None) -> Dict[str, str]:
-    
-    create_user(inviter_tg_id, inviter_username)
-    create_user(invited_tg_id, invited_username)
-    
-    # 1. Купон для приглашенного (скидка)
-    invited_coupon = create_coupon(
-        coupon_type='invited_discount',
-        discount_percent=invited_discount_percent,
-        stars_count=10,
-        owner_tg_id=invited_tg_id,
-        inviter_tg_id=inviter_tg_id,
-        invited_tg_id=invited_tg_id,
-        min_stars=10
-    )
-    
-    # 2. Купон для пригласившего (награда)
-    inviter_coupon = create_coupon(
-        coupon_type='inviter_reward',
-        discount_percent=inviter_reward_percent,
-        stars_count=1,
-        owner_tg_id=inviter_tg_id,
-        inviter_tg_id=inviter_tg_id,
-        invited_tg_id=invited_tg_id,
-        min_stars=1
-    )
-    
-    # Записываем в referrals
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO referrals(
-            inviter_tg_id, invited_tg_id, inviter_coupon_code, 
-            invited_coupon_code, status, created_at
-        ) VALUES (?,?,?,?,?,?)
-    """, (inviter_tg_id, invited_tg_id, inviter_coupon, invited_coupon, 
-          'pending', now().isoformat()))
-    
-    cur.execute("UPDATE users SET total_invites = total_invites + 1 WHERE tg_id = ?", 
-                (inviter_tg_id,))
-    
-    conn.commit()
-    conn.close()
-    
-    return {
-        'inviter_coupon': inviter_coupon,
-        'invited_coupon': invited_coupon
-    }
-
-def complete_purchase(buyer_tg_id: str, stars_count: int, coupon_code: Optional[str] = None) -> Dict[str, Any]:
-    
-    # Убедимся, что пользователь существует
-    create_user(buyer_tg_id)
-    
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    
-    used_discount_percent = 0
-    
-    if coupon_code:
-        cur.execute("""
-            SELECT discount_percent, min_stars, status, owner_tg_id, expires_at, code
-            FROM coupons WHERE code = ?
-        """, (coupon_code,))
-        coupon = cur.fetchone()
-        
-        if not coupon:
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_not_found'}
-            
-        discount_percent, min_stars, status, owner_tg_id, expires_at, code = coupon
-        
-        # Проверки купона
-        if status != 'active':
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_not_active'}
-        if now() > datetime.datetime.fromisoformat(expires_at):
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_expired'}
-        
-        # Проверка min_stars удалена по запросу
-        
-        if owner_tg_id != buyer_tg_id:
-            conn.close()
-            return {'ok': False, 'reason': 'coupon_belongs_to_another_user'}
-            
-        used_discount_percent = discount_percent
-        
-        # Помечаем купон использованным
-        cur.execute("""
-            UPDATE coupons 
-            SET status = 'used', used_at = ? 
-            WHERE code = ?
-        """, (now().isoformat(), coupon_code))
-        
-        # Если это был купон приглашенного, обновляем статус реферрала
-        cur.execute("""
-            UPDATE referrals 
-            SET status = 'completed', completed_at = ? 
-            WHERE invited_coupon_code = ?
-        """, (now().isoformat(), coupon_code))
-    
-    # Записываем покупку
-    cur.execute("""
-        INSERT INTO purchases(
-            buyer_tg_id, stars_count, coupon_code, discount_percent, created_at
-        ) VALUES (?,?,?,?,?)
-    """, (buyer_tg_id, stars_count, coupon_code, used_discount_percent, now().isoformat()))
-    
-    cur.execute("UPDATE users SET total_purchases = total_purchases + 1 WHERE tg_id = ?",
-                (buyer_tg_id,))
-    
-    conn.commit()
-    conn.close()
-    
-    return {
-        'ok': True,
-        'stars_count': stars_count,
-        'used_discount_percent': used_discount_percent
-    }
-
-# --- Admin helpers ---
-def list_coupons():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            c.code, c.coupon_type, c.discount_percent, c.stars_count, c.min_stars,
-            c.owner_tg_id,
-            u_owner.tg_username as owner_username,
-            c.inviter_tg_id,
-            u_inviter.tg_username as inviter_username,
-            c.invited_tg_id,
-            u_invited.tg_username as invited_username,
-            c.status,
-            c.created_at, c.expires_at, c.used_at
-        FROM coupons c
-        LEFT JOIN users u_owner ON c.owner_tg_id = u_owner.tg_id
-        LEFT JOIN users u_inviter ON c.inviter_tg_id = u_inviter.tg_id
-        LEFT JOIN users u_invited ON c.invited_tg_id = u_invited.tg_id
-        ORDER BY c.created_at DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def delete_coupon(code: str) -> Dict[str, Any]:
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM coupons WHERE code = ?", (code,))
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-
-    return {'ok': deleted, 'message': 'Coupon deleted' if deleted else 'Coupon not found'}
+import os
+import sqlite3
+import secrets
+import string
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, List, Tuple, Union
+
+import metrics
+import sqltrace
+from db_executor import DB_QUEUE_DEPTH, DBBusy
+
+__all__ = ['init_db', 'start_invite', 'complete_purchase', 'list_coupons', 'coupons_page', 'delete_coupon',
+           'get_coupon', 'validate_coupon']
+
+DB = 'referral.db'
+
+log = logging.getLogger(__name__)
+
+# --- connections ---
+# Одно соединение на поток (у каждого воркера uvicorn свои потоки), PRAGMA
+# применяются один раз при открытии, а не на каждый вызов.
+PRAGMAS = (
+    # До journal_mode: на новой базе режим фиксируется при создании файла, на
+    # существующей вступает в силу после VACUUM (manage.py migrate --vacuum)
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",    # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=268435456",  # 256 МБ
+    "PRAGMA temp_store=MEMORY",
+)
+
+_local = threading.local()
+
+# Кэши процесса привязаны к файлу базы: при смене DB они сбрасываются
+_caches = []
+_caches_db = None
+
+def get_conn() -> sqlite3.Connection:
+    global _caches_db
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.db != DB:
+        if conn is not None:
+            conn.close()
+        if _caches_db != DB:
+            for cache in _caches:
+                cache.clear()
+            _caches_db = DB
+        # isolation_level=None: транзакциями управляет transaction(), а не модуль sqlite3
+        factory = sqltrace.TracedConnection if sqltrace.SQL_TRACE else sqlite3.Connection
+        conn = sqlite3.connect(DB, isolation_level=None, factory=factory)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.db = DB
+    return conn
+
+def close_conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+# Соединение или курсор: у обоих есть execute/executemany
+DBHandle = Union[sqlite3.Connection, sqlite3.Cursor]
+
+# Действия после commit (сброс кэшей): до commit другой поток еще видит старые
+# данные и мог бы положить их обратно в кэш. Если транзакцию открыл не
+# transaction() (вызывающий передал свое соединение и коммитит сам), действие
+# отбрасывается: иначе оно сработало бы на чужом commit, даже после отката.
+def after_commit(fn):
+    if getattr(_local, 'transaction_conn', None) is None:
+        return
+    pending = getattr(_local, 'after_commit', None)
+    if pending is None:
+        pending = _local.after_commit = []
+    pending.append(fn)
+
+def _run_after_commit():
+    pending = getattr(_local, 'after_commit', None)
+    while pending:
+        pending.pop(0)()
+
+DB_LOCK_WAIT_SECONDS = metrics.Histogram('referral_db_lock_wait_seconds',
+                                         "Ожидание блокировки записи (BEGIN IMMEDIATE)")
+DB_TRANSACTION_SECONDS = metrics.Histogram('referral_db_transaction_seconds',
+                                           "Время от BEGIN до конца COMMIT")
+DB_COMMIT_SECONDS = metrics.Histogram('referral_db_commit_seconds', "Длительность COMMIT")
+DB_ROLLBACKS = metrics.Counter('referral_db_rollbacks_total', "Откаченные транзакции")
+
+def _discard_transaction(conn: sqlite3.Connection):
+    getattr(_local, 'after_commit', []).clear()
+    if conn.in_transaction:
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            log.exception("rollback failed")
+    DB_ROLLBACKS.inc()
+
+@contextmanager
+def transaction(conn: Optional[DBHandle] = None):
+    # Соединение/курсор вызывающего: транзакцией владеет он, мы только пишем в нее
+    if conn is not None:
+        yield conn
+        return
+    conn = get_conn()
+    # Внешний transaction() этого потока уже открыл транзакцию — присоединяемся к ней
+    if getattr(_local, 'transaction_conn', None) is conn:
+        yield conn
+        return
+    # Открытая транзакция, которую не открывал transaction() (например, COMMIT
+    # упал без отката): присоединиться к ней — значит никогда не закоммитить
+    if conn.in_transaction:
+        log.warning("rolling back a stray open transaction on %s", DB)
+        _discard_transaction(conn)
+    # IMMEDIATE сразу берет блокировку записи: без SQLITE_BUSY при апгрейде с чтения
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    locked = time.perf_counter()
+    DB_LOCK_WAIT_SECONDS.observe(locked - started)
+    _local.transaction_conn = conn
+    try:
+        yield conn
+        committing = time.perf_counter()
+        # COMMIT тоже может упасть (SQLITE_BUSY, диск): тогда откат, как при ошибке
+        conn.commit()
+    except BaseException:
+        _discard_transaction(conn)
+        raise
+    finally:
+        _local.transaction_conn = None
+    done = time.perf_counter()
+    DB_COMMIT_SECONDS.observe(done - committing)
+    DB_TRANSACTION_SECONDS.observe(done - locked)
+    _run_after_commit()
+
+# --- utils ---
+ALPHABET = ''.join([c for c in string.ascii_uppercase + string.digits if c not in "IO01"])
+CODE_LENGTH = int(os.environ.get('COUPON_CODE_LENGTH', 5))
+
+# В ALPHABET ровно 32 символа, 256 = 8 * 32: байт -> символ через translate без смещения
+_CODE_TABLE = bytes.maketrans(bytes(range(256)), ALPHABET.encode() * 8)
+
+# Время в БД — целые epoch-секунды UTC (см. SCHEMA_VERSION)
+def now_ts() -> int:
+    return int(time.time())
+
+# Пачка кодов из одного вызова CSPRNG вместо secrets.choice на каждый символ
+def gen_codes(n: int, length: Optional[int] = None) -> List[str]:
+    length = length or CODE_LENGTH
+    chars = secrets.token_bytes(n * length).translate(_CODE_TABLE).decode('ascii')
+    return [chars[i:i + length] for i in range(0, n * length, length)]
+
+def gen_code(length: Optional[int] = None) -> str:
+    return gen_codes(1, length)[0]
+
+# --- DB init ---
+# Индексы под горячие запросы; check_query_plans() следит, чтобы они использовались.
+# Джойны users по tg_id покрывает автоиндекс UNIQUE(tg_id).
+INDEXES = (
+    # погашение купона: UPDATE referrals ... WHERE invited_coupon_code = ?
+    "CREATE INDEX IF NOT EXISTS idx_referrals_invited_coupon ON referrals(invited_coupon_code)",
+    # list_coupons: ORDER BY created_at DESC (code — для однозначного порядка)
+    "CREATE INDEX IF NOT EXISTS idx_coupons_created ON coupons(created_at, code)",
+    # фоновое истечение: только активные купоны, уже истекшие в индекс не попадают
+    "CREATE INDEX IF NOT EXISTS idx_coupons_active_expiry ON coupons(expires_at) WHERE status = 'active'",
+    "CREATE INDEX IF NOT EXISTS idx_purchases_buyer ON purchases(buyer_tg_id)",
+    # выгрузка по диапазону дат: keyset по (created_at, id)
+    "CREATE INDEX IF NOT EXISTS idx_referrals_created ON referrals(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_purchases_created ON purchases(created_at)",
+    # архивация: только закрытые строки, по времени закрытия
+    "CREATE INDEX IF NOT EXISTS idx_coupons_archivable ON coupons(COALESCE(used_at, expires_at))"
+    " WHERE status IN ('used', 'expired')",
+    "CREATE INDEX IF NOT EXISTS idx_referrals_archivable ON referrals(completed_at) WHERE status = 'completed'",
+    # list_coupons(include_archived=True)
+    "CREATE INDEX IF NOT EXISTS idx_coupons_archive_created ON coupons_archive(created_at, code)",
+    # выгрузка рефералов вместе с архивом
+    "CREATE INDEX IF NOT EXISTS idx_referrals_archive_created ON referrals_archive(created_at)",
+    # поиск на дашборде (search_coupons): купоны пользователя в каждой роли уже
+    # в порядке страницы, username без учета регистра
+    "CREATE INDEX IF NOT EXISTS idx_coupons_owner_created ON coupons(owner_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_inviter_created ON coupons(inviter_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_invited_created ON coupons(invited_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_archive_owner ON coupons_archive(owner_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_archive_inviter ON coupons_archive(inviter_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_archive_invited ON coupons_archive(invited_tg_id, created_at, code)",
+    "CREATE INDEX IF NOT EXISTS idx_coupons_closed_created ON coupons(status, created_at, code)"
+    " WHERE status != 'active'",
+    "CREATE INDEX IF NOT EXISTS idx_users_username ON users(tg_username COLLATE NOCASE)",
+    # удаление просроченных ключей идемпотентности
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)",
+)
+# Индексы, которые больше не нужны, а запись платит за каждый: купоны по owner_tg_id
+# ищут по idx_coupons_owner_created, истечение — по частичному idx_coupons_active_expiry.
+DROPPED_INDEXES = ('idx_coupons_owner_status', 'idx_coupons_expires')
+
+# Версия схемы в PRAGMA user_version:
+#   0 — created_at/expires_at/used_at/completed_at хранятся ISO-8601 TEXT,
+#   1 — INTEGER epoch-секунды (UTC): сравнения и диапазоны считаются в SQL,
+#       строки короче, разбирать fromisoformat на каждой строке не нужно.
+SCHEMA_VERSION = 1
+
+TABLES = {
+    # Таблица пользователей
+    'users': """
+    CREATE TABLE IF NOT EXISTS users(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id TEXT UNIQUE,
+        tg_username TEXT,
+        total_invites INTEGER DEFAULT 0,
+        total_purchases INTEGER DEFAULT 0,
+        created_at INTEGER
+    )""",
+    
+    # Таблица купонов
+    'coupons': """
+    CREATE TABLE IF NOT EXISTS coupons(
+        code TEXT PRIMARY KEY,
+        coupon_type TEXT,  -- 'invited_discount' или 'inviter_reward'
+        discount_percent INTEGER,  -- процент скидки
+        stars_count INTEGER,  -- количество звезд, на которое действует купон (для информации)
+        min_stars INTEGER DEFAULT 1,  -- минимальное количество звезд для применения купона
+        owner_tg_id TEXT,  -- владелец купона (tg_id)
+        inviter_tg_id TEXT,  -- кто пригласил
+        invited_tg_id TEXT,  -- кого пригласили
+        status TEXT,  -- 'active', 'used', 'expired'
+        created_at INTEGER,
+        expires_at INTEGER,
+        used_at INTEGER
+    )""",
+    
+    # Таблица рефералов
+    'referrals': """
+    CREATE TABLE IF NOT EXISTS referrals(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        inviter_tg_id TEXT,
+        invited_tg_id TEXT,
+        inviter_coupon_code TEXT,
+        invited_coupon_code TEXT,
+        status TEXT,
+        created_at INTEGER,
+        completed_at INTEGER
+    )""",
+    
+    # Таблица покупок (ПРОВЕРЕНО: содержит discount_percent)
+    'purchases': """
+    CREATE TABLE IF NOT EXISTS purchases(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer_tg_id TEXT,
+        stars_count INTEGER,  -- количество купленных звезд
+        coupon_code TEXT,  -- использованный купон
+        discount_percent INTEGER, -- процент использованной скидки
+        created_at INTEGER
+    )""",
+    
+    # Холодные копии used/expired купонов и completed рефералов старше
+    # ARCHIVE_RETENTION_DAYS (см. archive_old_rows); archived_at — когда перенесены
+    'coupons_archive': """
+    CREATE TABLE IF NOT EXISTS coupons_archive(
+        code TEXT PRIMARY KEY,
+        coupon_type TEXT,
+        discount_percent INTEGER,
+        stars_count INTEGER,
+        min_stars INTEGER,
+        owner_tg_id TEXT,
+        inviter_tg_id TEXT,
+        invited_tg_id TEXT,
+        status TEXT,
+        created_at INTEGER,
+        expires_at INTEGER,
+        used_at INTEGER,
+        archived_at INTEGER
+    )""",
+    
+    'referrals_archive': """
+    CREATE TABLE IF NOT EXISTS referrals_archive(
+        id INTEGER PRIMARY KEY,
+        inviter_tg_id TEXT,
+        invited_tg_id TEXT,
+        inviter_coupon_code TEXT,
+        invited_coupon_code TEXT,
+        status TEXT,
+        created_at INTEGER,
+        completed_at INTEGER,
+        archived_at INTEGER
+    )""",
+    
+    # Результаты покупок по Idempotency-Key (см. idempotent_purchase): request —
+    # параметры покупки, result — ответ в JSON. WITHOUT ROWID: строка лежит прямо
+    # в b-дереве ключа, без отдельного rowid.
+    'idempotency_keys': """
+    CREATE TABLE IF NOT EXISTS idempotency_keys(
+        key TEXT PRIMARY KEY,
+        request TEXT,
+        result TEXT,
+        created_at INTEGER
+    ) WITHOUT ROWID""",
+    
+    # Заранее сгенерированные коды; id дает дешевую выборку "первого" кода
+    'code_pool': """
+    CREATE TABLE IF NOT EXISTS code_pool(
+        id INTEGER PRIMARY KEY,
+        code TEXT UNIQUE
+    )""",
+    
+    # Сводные счетчики для /stats, обновляются в тех же транзакциях, что и данные
+    'stats': """
+    CREATE TABLE IF NOT EXISTS stats(
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+}
+
+TIMESTAMP_COLUMNS = {
+    'users': ('created_at',),
+    'coupons': ('created_at', 'expires_at', 'used_at'),
+    'referrals': ('created_at', 'completed_at'),
+    'purchases': ('created_at',),
+}
+
+def _table_exists(cur: DBHandle, table: str) -> bool:
+    return cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def schema_version(cur: DBHandle) -> int:
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+# Миграция 0 -> 1 на месте, в транзакции вызывающего. Колонки TEXT превращают
+# записанное число обратно в текст, поэтому таблицы пересоздаются: старая
+# переименовывается, данные копируются с переводом ISO-строк в epoch-секунды.
+def migrate_epoch_timestamps(cur: DBHandle) -> Dict[str, int]:
+    legacy = [table for table in TIMESTAMP_COLUMNS if _table_exists(cur, table)]
+    for table in legacy:
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+    copied = {}
+    for table in legacy:
+        cur.execute(TABLES[table])
+        columns = [row[1] for row in cur.execute(f"PRAGMA table_info({table}_legacy)")]
+        exprs = [
+            f"CASE WHEN typeof({c}) = 'text' THEN CAST(strftime('%s', {c}) AS INTEGER) ELSE {c} END"
+            if c in TIMESTAMP_COLUMNS[table] else c
+            for c in columns
+        ]
+        copied[table] = cur.execute(
+            f"INSERT INTO {table}({', '.join(columns)}) SELECT {', '.join(exprs)} FROM {table}_legacy"
+        ).rowcount
+        # Индексы старой таблицы уходят вместе с ней и создаются заново в init_db
+        cur.execute(f"DROP TABLE {table}_legacy")
+    return copied
+
+def init_db():
+    with transaction() as cur:
+        if schema_version(cur) < 1 and _table_exists(cur, 'coupons'):
+            log.warning("migrating %s to epoch timestamps (schema version 1)", DB)
+            migrate_epoch_timestamps(cur)
+        
+        for ddl in TABLES.values():
+            cur.execute(ddl)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        
+        for ddl in INDEXES:
+            cur.execute(ddl)
+        for name in DROPPED_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+        
+        # Новая таблица stats на существующей базе: один раз пересчитываем
+        if not cur.execute("SELECT 1 FROM stats LIMIT 1").fetchone():
+            rebuild_stats(cur)
+
+# --- caches ---
+# Ограниченный LRU с TTL; потокобезопасный, считает попадания и промахи
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()  # key -> (deadline, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        _caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return default
+
+    # ttl — для записи, которой осталось жить меньше self.ttl
+    def put(self, key, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._items[key] = (time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl)), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._items)
+            self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+# --- background workers ---
+# Поток, который раз в interval секунд вызывает tick(). Любые ошибки tick()
+# (базы, исчерпание кодов в allocate_codes) логируются и не останавливают поток;
+# у потока свое соединение, закрываемое при выходе.
+class PeriodicWorker(threading.Thread):
+    def __init__(self, name: str, interval: float):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def tick(self):
+        raise NotImplementedError
+
+    # True, если за время ожидания поток попросили остановиться
+    def wait(self, seconds: float) -> bool:
+        return self._stopped.wait(seconds)
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.tick()
+                except Exception:
+                    log.exception("%s failed", self.name)
+                self.wait(self.interval)
+        finally:
+            close_conn()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+# --- stats ---
+# Ключи: coupons:<тип>:<статус>, referrals:<статус>, purchases, purchases:discount_percent_total.
+# Счетчики меняются в транзакции той операции, которая меняет данные, поэтому
+# /stats читает несколько строк вместо COUNT(*)/SUM по большим таблицам.
+BUMP_STATS_SQL = """
+    INSERT INTO stats(key, value) VALUES (?, ?)
+    ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+"""
+
+def coupon_stat_key(coupon_type: Optional[str], status: Optional[str]) -> str:
+    return f"coupons:{coupon_type or 'unknown'}:{status or 'unknown'}"
+
+def bump_stats(cur: DBHandle, deltas: Dict[str, int]):
+    cur.executemany(BUMP_STATS_SQL, [(key, delta) for key, delta in deltas.items() if delta])
+
+# Полный пересчет из таблиц — для починки расхождений (manage.py rebuild-stats)
+@metrics.timed
+def rebuild_stats(conn: Optional[DBHandle] = None):
+    with transaction(conn) as cur:
+        cur.execute("DELETE FROM stats")
+        cur.execute("""
+            INSERT INTO stats(key, value)
+            SELECT 'coupons:' || COALESCE(coupon_type, 'unknown') || ':' || COALESCE(status, 'unknown'),
+                   COUNT(*)
+            FROM (SELECT coupon_type, status FROM coupons
+                  UNION ALL SELECT coupon_type, status FROM coupons_archive)
+            GROUP BY 1
+        """)
+        cur.execute("""
+            INSERT INTO stats(key, value)
+            SELECT 'referrals:' || COALESCE(status, 'unknown'), COUNT(*)
+            FROM (SELECT status FROM referrals UNION ALL SELECT status FROM referrals_archive)
+            GROUP BY 1
+        """)
+        cur.execute("""
+            INSERT INTO stats(key, value)
+            SELECT 'purchases', COUNT(*) FROM purchases
+            UNION ALL
+            SELECT 'purchases:discount_percent_total', COALESCE(SUM(discount_percent), 0) FROM purchases
+        """)
+
+# Купоны (вместе с архивом) с таким типом и/или статусом по счетчикам, None — любой
+def count_coupons(coupon_type: Optional[str] = None, status: Optional[str] = None,
+                  conn: Optional[DBHandle] = None) -> int:
+    conn = conn or get_conn()
+    total = 0
+    for key, value in conn.execute("SELECT key, value FROM stats WHERE key >= 'coupons:' AND key < 'coupons;'"):
+        _, stat_type, stat_status = key.split(':', 2)
+        if coupon_type in (None, stat_type) and status in (None, stat_status):
+            total += value
+    return total
+
+@metrics.timed
+def read_stats() -> Dict[str, Any]:
+    result: Dict[str, Any] = {
+        'coupons': {},
+        'referrals': {},
+        'purchases': 0,
+        'discount_percent_total': 0,
+    }
+    for key, value in get_conn().execute("SELECT key, value FROM stats"):
+        kind, _, rest = key.partition(':')
+        if kind == 'coupons':
+            coupon_type, _, status = rest.partition(':')
+            result['coupons'].setdefault(coupon_type, {})[status] = value
+        elif kind == 'referrals':
+            result['referrals'][rest] = value
+        elif key == 'purchases':
+            result['purchases'] = value
+        elif key == 'purchases:discount_percent_total':
+            result['discount_percent_total'] = value
+    return result
+
+# --- user operations ---
+# Известные пользователи (tg_id -> username): повторные вызовы create_user с тем же
+# username не ходят в базу. TTL ограничивает устаревание, если username поменял
+# другой воркер.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 100000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300.0))
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_UNKNOWN = object()
+
+# Создаем пользователя или обновляем username, если он предоставлен и изменился
+UPSERT_USER_SQL = """
+    INSERT INTO users(tg_id, tg_username, created_at) VALUES(?,?,?)
+    ON CONFLICT(tg_id) DO UPDATE SET tg_username = excluded.tg_username
+    WHERE excluded.tg_username IS NOT NULL AND tg_username IS NOT excluded.tg_username
+"""
+
+def create_user(tg_id, tg_username=None, conn: Optional[DBHandle] = None):
+    tg_username = tg_username or None
+    cached = user_cache.get(tg_id, _UNKNOWN)
+    if cached is not _UNKNOWN and (tg_username is None or tg_username == cached):
+        return tg_id
+    
+    with transaction(conn) as cur:
+        cur.execute(UPSERT_USER_SQL, (tg_id, tg_username, now_ts()))
+        # Без username не затираем уже известный
+        if tg_username is not None or cached is _UNKNOWN:
+            # В кэш — только после commit: откаченный пользователь не должен считаться
+            # созданным. С чужой транзакцией (не transaction()) кэш не заполняется.
+            after_commit(lambda: user_cache.put(tg_id, tg_username))
+    
+    return tg_id
+
+
+# --- coupon operations ---
+MAX_ALLOCATION_ROUNDS = 10
+
+# Вся пачка проверяется одним запросом: коды передаются одним JSON-параметром.
+# Коды, лежащие в code_pool, тоже заняты.
+EXISTING_CODES_SQL = """
+    SELECT code FROM coupons WHERE code IN (SELECT value FROM json_each(?1))
+    UNION ALL
+    SELECT code FROM code_pool WHERE code IN (SELECT value FROM json_each(?1))
+    UNION ALL
+    SELECT code FROM coupons_archive WHERE code IN (SELECT value FROM json_each(?1))
+"""
+
+def existing_codes(cur: DBHandle, codes) -> set:
+    return {row[0] for row in cur.execute(EXISTING_CODES_SQL, (json.dumps(list(codes)),))}
+
+# Выдает n уникальных кодов, которых еще нет в coupons. Повторно генерируются
+# только столкнувшиеся коды. Внутри транзакции вызывающего (BEGIN IMMEDIATE)
+# проверка и последующий INSERT не разделены чужой записью.
+@metrics.timed
+def allocate_codes(n: int, length: Optional[int] = None,
+                   conn: Optional[DBHandle] = None) -> List[str]:
+    cur = conn if conn is not None else get_conn()
+    codes: List[str] = []
+    taken = set()
+    for _ in range(MAX_ALLOCATION_ROUNDS):
+        batch = {code for code in gen_codes(n - len(codes), length) if code not in taken}
+        fresh = batch - existing_codes(cur, batch)
+        codes.extend(fresh)
+        taken |= batch
+        if len(codes) == n:
+            return codes
+    raise RuntimeError(f"coupon code space exhausted after {MAX_ALLOCATION_ROUNDS} rounds, "
+                       f"increase COUPON_CODE_LENGTH")
+
+# --- code pool ---
+# Пул заранее сгенерированных кодов: в запросе код только забирается из пула.
+# Забор идет в транзакции вызывающего под блокировкой записи, поэтому один код
+# не достанется двум воркерам. Пустой пул — не ошибка, коды генерируются на месте.
+CODE_POOL_LOW = int(os.environ.get('CODE_POOL_LOW', 1000))          # ниже — начинаем пополнять
+CODE_POOL_HIGH = int(os.environ.get('CODE_POOL_HIGH', 5000))        # пополняем до этого уровня
+CODE_POOL_BATCH = int(os.environ.get('CODE_POOL_BATCH', 500))       # кодов за одну транзакцию
+CODE_POOL_INTERVAL = float(os.environ.get('CODE_POOL_INTERVAL', 1.0))  # секунд между пачками
+
+CLAIM_CODE_SQL = """
+    DELETE FROM code_pool WHERE id = (SELECT MIN(id) FROM code_pool) RETURNING code
+"""
+
+_code_pool_lock = threading.Lock()
+_code_pool_stats = {
+    'claims': 0,
+    'claimed_from_pool': 0,
+    'generated_on_demand': 0,
+    'claim_seconds_total': 0.0,
+    'claim_seconds_max': 0.0,
+    'refills': 0,
+    'refilled_codes': 0,
+}
+
+@metrics.timed
+def claim_codes(n: int, conn: Optional[DBHandle] = None) -> List[str]:
+    started = time.perf_counter()
+    cur = conn if conn is not None else get_conn()
+    codes = []
+    for _ in range(n):
+        row = cur.execute(CLAIM_CODE_SQL).fetchone()
+        if row is None:
+            break
+        codes.append(row[0])
+    from_pool = len(codes)
+    if from_pool < n:
+        codes.extend(allocate_codes(n - from_pool, conn=cur))
+    elapsed = time.perf_counter() - started
+    with _code_pool_lock:
+        _code_pool_stats['claims'] += 1
+        _code_pool_stats['claimed_from_pool'] += from_pool
+        _code_pool_stats['generated_on_demand'] += n - from_pool
+        _code_pool_stats['claim_seconds_total'] += elapsed
+        _code_pool_stats['claim_seconds_max'] = max(_code_pool_stats['claim_seconds_max'], elapsed)
+    return codes
+
+def code_pool_size(conn: Optional[DBHandle] = None) -> int:
+    cur = conn if conn is not None else get_conn()
+    return cur.execute("SELECT COUNT(*) FROM code_pool").fetchone()[0]
+
+# Одна пачка пополнения (не больше batch кодов) в короткой транзакции
+@metrics.timed
+def refill_code_pool(high: int = CODE_POOL_HIGH, batch: int = CODE_POOL_BATCH) -> int:
+    with transaction() as cur:
+        need = min(high - code_pool_size(cur), batch)
+        if need <= 0:
+            return 0
+        codes = allocate_codes(need, conn=cur)
+        cur.executemany("INSERT INTO code_pool(code) VALUES (?)", ((code,) for code in codes))
+    with _code_pool_lock:
+        _code_pool_stats['refills'] += 1
+        _code_pool_stats['refilled_codes'] += need
+    return need
+
+def code_pool_stats() -> Dict[str, Any]:
+    with _code_pool_lock:
+        stats = dict(_code_pool_stats)
+    stats['size'] = code_pool_size()
+    stats['claim_seconds_avg'] = stats['claim_seconds_total'] / stats['claims'] if stats['claims'] else 0.0
+    return stats
+
+# Фоновое пополнение: когда пул опускается ниже low, доливаем его до high пачками
+# по batch кодов раз в interval секунд. Каждый воркер может запускать свой
+# поток — размер пула пересчитывается под блокировкой записи.
+class CodePoolRefiller(PeriodicWorker):
+    def __init__(self, low: int = CODE_POOL_LOW, high: int = CODE_POOL_HIGH,
+                 batch: int = CODE_POOL_BATCH, interval: float = CODE_POOL_INTERVAL):
+        super().__init__('code-pool-refiller', interval)
+        self.low, self.high, self.batch = low, high, batch
+
+    def tick(self):
+        if code_pool_size() < self.low:
+            while refill_code_pool(self.high, self.batch) and not self.wait(self.interval):
+                pass
+
+INSERT_COUPON_SQL = """
+    INSERT INTO coupons(
+        code, coupon_type, discount_percent, stars_count, min_stars,
+        owner_tg_id, inviter_tg_id, invited_tg_id, status, created_at, expires_at
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+def create_coupon(coupon_type, discount_percent, stars_count, owner_tg_id=None, 
+                  inviter_tg_id=None, invited_tg_id=None, min_stars=1, days_valid=30,
+                  code: Optional[str] = None, conn: Optional[DBHandle] = None):
+    created = now_ts()
+    expires = created + days_valid * 86400
+    
+    with transaction(conn) as cur:
+        if code is None:
+            code = claim_codes(1, conn=cur)[0]
+        cur.execute(INSERT_COUPON_SQL, (code, coupon_type, discount_percent, stars_count, min_stars,
+                                        owner_tg_id, inviter_tg_id, invited_tg_id, 'active',
+                                        created, expires))
+        bump_stats(cur, {coupon_stat_key(coupon_type, 'active'): 1})
+    return code
+
+
+# --- coupon cache ---
+# Ограниченный LRU-кэш записей купонов с TTL для повторных проверок кода.
+# Сбрасывается после погашения и удаления купона. Изменения из других процессов
+# ловятся по PRAGMA data_version (COUPON_CACHE_DATA_VERSION=1), иначе их
+# видимость ограничена TTL.
+COUPON_CACHE_SIZE = int(os.environ.get('COUPON_CACHE_SIZE', 10000))
+COUPON_CACHE_TTL = float(os.environ.get('COUPON_CACHE_TTL', 30.0))
+COUPON_CACHE_DATA_VERSION = os.environ.get('COUPON_CACHE_DATA_VERSION') == '1'
+
+COUPON_FIELDS = ('code', 'coupon_type', 'discount_percent', 'stars_count', 'min_stars',
+                 'owner_tg_id', 'status', 'expires_at')
+
+GET_COUPON_SQL = f"SELECT {', '.join(COUPON_FIELDS)} FROM coupons WHERE code = ?"
+
+coupon_cache = LRUCache(COUPON_CACHE_SIZE, COUPON_CACHE_TTL)
+
+def invalidate_coupon(code: str):
+    # Сразу и еще раз после commit: между ними читатель мог закэшировать старую запись
+    coupon_cache.invalidate(code)
+    after_commit(lambda: coupon_cache.invalidate(code))
+
+# data_version соединения меняется, когда базу закоммитило другое соединение
+def _check_data_version(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if getattr(_local, 'data_version', None) != version:
+        coupon_cache.clear()
+        _local.data_version = version
+
+def get_coupon(code: str) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    if COUPON_CACHE_DATA_VERSION:
+        _check_data_version(conn)
+    coupon = coupon_cache.get(code)
+    if coupon is None:
+        row = conn.execute(GET_COUPON_SQL, (code,)).fetchone()
+        if row is None:
+            return None
+        coupon = dict(zip(COUPON_FIELDS, row))
+        coupon_cache.put(code, coupon)
+    return coupon
+
+def coupon_rejection(status: str, owner_tg_id: str, expires_at: int,
+                     buyer_tg_id: str, ts: int) -> Optional[str]:
+    if status == 'expired':
+        return 'coupon_expired'
+    if status != 'active':
+        return 'coupon_not_active'
+    if expires_at <= ts:
+        return 'coupon_expired'
+    if owner_tg_id != buyer_tg_id:
+        return 'coupon_belongs_to_another_user'
+    return None
+
+COUPON_VALIDATIONS = metrics.Counter('referral_coupon_validations_total',
+                                     "Предварительные проверки купона", ('outcome',))
+
+# Код, которого нет в coupons, мог уйти в архив: причина та же, что была бы до переноса
+def _archived_rejection(cur: DBHandle, code: str, buyer_tg_id: str, ts: int) -> str:
+    coupon = cur.execute(
+        "SELECT status, owner_tg_id, expires_at FROM coupons_archive WHERE code = ?", (code,)
+    ).fetchone()
+    if not coupon:
+        return 'coupon_not_found'
+    return coupon_rejection(*coupon, buyer_tg_id, ts) or 'coupon_not_active'
+
+# Предварительная проверка кода (бот до подтверждения покупки), читает из кэша
+@metrics.timed
+def validate_coupon(code: str, buyer_tg_id: str) -> Dict[str, Any]:
+    coupon = get_coupon(code)
+    if coupon is None:
+        reason = _archived_rejection(get_conn(), code, buyer_tg_id, now_ts())
+        COUPON_VALIDATIONS.inc(outcome=reason)
+        return {'ok': False, 'reason': reason}
+    reason = coupon_rejection(coupon['status'], coupon['owner_tg_id'], coupon['expires_at'],
+                              buyer_tg_id, now_ts())
+    COUPON_VALIDATIONS.inc(outcome=reason or 'ok')
+    if reason:
+        return {'ok': False, 'reason': reason}
+    return {'ok': True, 'discount_percent': coupon['discount_percent']}
+
+def coupon_cache_stats() -> Dict[str, Any]:
+    return coupon_cache.stats()
+
+# --- invite and purchase flow ---
+INSERT_REFERRAL_SQL = """
+    INSERT INTO referrals(
+        inviter_tg_id, invited_tg_id, inviter_coupon_code, 
+        invited_coupon_code, status, created_at
+    ) VALUES (?,?,?,?,?,?)
+"""
+
+ADD_INVITES_SQL = "UPDATE users SET total_invites = total_invites + ? WHERE tg_id = ?"
+
+# Весь инвайт — одна транзакция и один commit: пользователи, оба купона,
+# referrals и счетчик. При сбое посередине не остается купонов без реферала.
+@metrics.timed
+def start_invite(inviter_tg_id, invited_tg_id, 
+                 invited_discount_percent: int, inviter_reward_percent: int,
+                 inviter_username=None, invited_username=None,
+                 conn: Optional[DBHandle] = None) -> Dict[str, str]:
+    
+    with transaction(conn) as cur:
+        create_user(inviter_tg_id, inviter_username, conn=cur)
+        create_user(invited_tg_id, invited_username, conn=cur)
+        
+        invited_code, inviter_code = claim_codes(2, conn=cur)
+        
+        # 1. Купон для приглашенного (скидка)
+        invited_coupon = create_coupon(
+            coupon_type='invited_discount',
+            discount_percent=invited_discount_percent,
+            stars_count=10,
+            owner_tg_id=invited_tg_id,
+            inviter_tg_id=inviter_tg_id,
+            invited_tg_id=invited_tg_id,
+            min_stars=10,
+            code=invited_code,
+            conn=cur
+        )
+        
+        # 2. Купон для пригласившего (награда)
+        inviter_coupon = create_coupon(
+            coupon_type='inviter_reward',
+            discount_percent=inviter_reward_percent,
+            stars_count=1,
+            owner_tg_id=inviter_tg_id,
+            inviter_tg_id=inviter_tg_id,
+            invited_tg_id=invited_tg_id,
+            min_stars=1,
+            code=inviter_code,
+            conn=cur
+        )
+        
+        # Записываем в referrals
+        cur.execute(INSERT_REFERRAL_SQL, (inviter_tg_id, invited_tg_id, inviter_coupon,
+                                          invited_coupon, 'pending', now_ts()))
+        
+        cur.execute(ADD_INVITES_SQL, (1, inviter_tg_id))
+        bump_stats(cur, {'referrals:pending': 1})
+    
+    return {
+        'inviter_coupon': inviter_coupon,
+        'invited_coupon': invited_coupon
+    }
+
+REDEEM_COUPON_SQL = """
+    UPDATE coupons 
+    SET status = 'used', used_at = ? 
+    WHERE code = ? AND status = 'active' AND owner_tg_id = ? AND expires_at > ?
+    RETURNING discount_percent, coupon_type
+"""
+
+COMPLETE_REFERRAL_SQL = """
+    UPDATE referrals 
+    SET status = 'completed', completed_at = ? 
+    WHERE invited_coupon_code = ?
+"""
+
+# outcome — 'redeemed' или причина отказа (coupon_not_found, coupon_expired, ...)
+COUPON_REDEMPTIONS = metrics.Counter('referral_coupon_redemptions_total',
+                                     "Попытки погасить купон при покупке", ('outcome',))
+
+# Причина отказа ищется только когда условный UPDATE не сработал
+def _rejection_reason(cur: DBHandle, coupon_code: str, buyer_tg_id: str, ts: int) -> str:
+    coupon = cur.execute(
+        "SELECT status, owner_tg_id, expires_at FROM coupons WHERE code = ?", (coupon_code,)
+    ).fetchone()
+    if not coupon:
+        return _archived_rejection(cur, coupon_code, buyer_tg_id, ts)
+    return coupon_rejection(*coupon, buyer_tg_id, ts) or 'coupon_not_active'
+
+@metrics.timed
+def complete_purchase(buyer_tg_id: str, stars_count: int, coupon_code: Optional[str] = None,
+                      conn: Optional[DBHandle] = None) -> Dict[str, Any]:
+    
+    with transaction(conn) as cur:
+        # Убедимся, что пользователь существует
+        create_user(buyer_tg_id, conn=cur)
+        
+        used_discount_percent = 0
+        ts = now_ts()
+        
+        if coupon_code:
+            # Compare-and-swap: проверки и погашение одним UPDATE, поэтому две
+            # параллельные покупки (в т.ч. из разных воркеров) не потратят купон дважды.
+            # Проверка min_stars удалена по запросу
+            coupon = cur.execute(REDEEM_COUPON_SQL, (ts, coupon_code, buyer_tg_id, ts)).fetchone()
+            
+            if not coupon:
+                reason = _rejection_reason(cur, coupon_code, buyer_tg_id, ts)
+                after_commit(lambda: COUPON_REDEMPTIONS.inc(outcome=reason))
+                return {'ok': False, 'reason': reason}
+                
+            used_discount_percent, coupon_type = coupon
+            after_commit(lambda: COUPON_REDEMPTIONS.inc(outcome='redeemed'))
+            invalidate_coupon(coupon_code)
+            
+            # Если это был купон приглашенного, обновляем статус реферрала
+            completed = cur.execute(COMPLETE_REFERRAL_SQL, (ts, coupon_code)).rowcount
+            bump_stats(cur, {
+                coupon_stat_key(coupon_type, 'active'): -1,
+                coupon_stat_key(coupon_type, 'used'): 1,
+                'referrals:pending': -completed,
+                'referrals:completed': completed,
+            })
+        
+        # Записываем покупку
+        cur.execute("""
+            INSERT INTO purchases(
+                buyer_tg_id, stars_count, coupon_code, discount_percent, created_at
+            ) VALUES (?,?,?,?,?)
+        """, (buyer_tg_id, stars_count, coupon_code, used_discount_percent, ts))
+        
+        cur.execute("UPDATE users SET total_purchases = total_purchases + 1 WHERE tg_id = ?",
+                    (buyer_tg_id,))
+        bump_stats(cur, {'purchases': 1, 'purchases:discount_percent_total': used_discount_percent})
+    
+    return {
+        'ok': True,
+        'stars_count': stars_count,
+        'used_discount_percent': used_discount_percent
+    }
+
+# --- bulk import ---
+# Импорт рефералов партнеров пачками по IMPORT_CHUNK строк: на пачку одна
+# транзакция, коды выделяются одним allocate_codes (пул кодов для интерактивных
+# инвайтов не трогаем), пользователи, купоны и рефералы пишутся executemany.
+# Купоны — те же, что выдает start_invite.
+IMPORT_CHUNK = int(os.environ.get('IMPORT_CHUNK', 1000))
+
+InviteRow = Tuple[str, str, int, int, Optional[str], Optional[str]]
+
+# Тот же диапазон, что у полей формы /invite (min="1" max="99")
+INVITE_PERCENT_MIN, INVITE_PERCENT_MAX = 1, 99
+
+def _percent(row: Dict[str, Any], field: str) -> int:
+    value = row.get(field)
+    if value is None or value == '':
+        raise ValueError(f"missing field {field}")
+    try:
+        percent = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an integer") from None
+    if not INVITE_PERCENT_MIN <= percent <= INVITE_PERCENT_MAX:
+        raise ValueError(f"{field} must be between {INVITE_PERCENT_MIN} and {INVITE_PERCENT_MAX}")
+    return percent
+
+# Строка импорта (поля как у формы /invite) -> InviteRow; ValueError с причиной
+def parse_invite(row: Any) -> InviteRow:
+    if not isinstance(row, dict):
+        raise ValueError("expected an object")
+    ids = []
+    for field in ('inviter_id', 'invited_id'):
+        value = row.get(field)
+        value = str(value).strip() if value is not None else ''
+        if not value:
+            raise ValueError(f"missing field {field}")
+        ids.append(value)
+    if ids[0] == ids[1]:
+        raise ValueError("inviter_id and invited_id must differ")
+    return (ids[0], ids[1],
+            _percent(row, 'invited_discount'), _percent(row, 'inviter_reward'),
+            row.get('inviter_username') or None, row.get('invited_username') or None)
+
+def _write_invites(invites: List[InviteRow], conn: Optional[DBHandle] = None):
+    ts = now_ts()
+    expires = ts + 30 * 86400
+    users: Dict[str, Optional[str]] = {}
+    for inviter, invited, _, _, inviter_username, invited_username in invites:
+        for tg_id, username in ((inviter, inviter_username), (invited, invited_username)):
+            if users.get(tg_id) is None:
+                users[tg_id] = username
+    
+    with transaction(conn) as cur:
+        cur.executemany(UPSERT_USER_SQL, [(tg_id, username, ts) for tg_id, username in users.items()])
+        codes = allocate_codes(2 * len(invites), conn=cur)
+        coupons, referrals = [], []
+        for i, (inviter, invited, invited_discount, inviter_reward, _, _) in enumerate(invites):
+            invited_code, inviter_code = codes[2 * i], codes[2 * i + 1]
+            coupons.append((invited_code, 'invited_discount', invited_discount, 10, 10,
+                            invited, inviter, invited, 'active', ts, expires))
+            coupons.append((inviter_code, 'inviter_reward', inviter_reward, 1, 1,
+                            inviter, inviter, invited, 'active', ts, expires))
+            referrals.append((inviter, invited, inviter_code, invited_code, 'pending', ts))
+        cur.executemany(INSERT_COUPON_SQL, coupons)
+        cur.executemany(INSERT_REFERRAL_SQL, referrals)
+        invites_by_user = Counter(invite[0] for invite in invites)
+        cur.executemany(ADD_INVITES_SQL, [(n, tg_id) for tg_id, n in invites_by_user.items()])
+        bump_stats(cur, {
+            coupon_stat_key('invited_discount', 'active'): len(invites),
+            coupon_stat_key('inviter_reward', 'active'): len(invites),
+            'referrals:pending': len(invites),
+        })
+    # username мог измениться в обход кэша
+    for tg_id in users:
+        user_cache.invalidate(tg_id)
+
+# rows — пары (номер строки во входных данных, объект строки).
+# Ошибочные строки не мешают остальным: если пачка не записалась целиком,
+# строки пишутся по одной, каждая в своем SAVEPOINT.
+@metrics.timed
+def import_invites_chunk(rows: List[Tuple[int, Any]]) -> Dict[str, Any]:
+    parsed, errors = [], []
+    for line, row in rows:
+        try:
+            parsed.append((line, parse_invite(row)))
+        except ValueError as e:
+            errors.append({'line': line, 'error': str(e)})
+    
+    imported = 0
+    if parsed:
+        try:
+            _write_invites([invite for _, invite in parsed])
+            imported = len(parsed)
+        except sqlite3.Error:
+            log.warning("import chunk failed, retrying %d rows one by one", len(parsed), exc_info=True)
+            with transaction() as cur:
+                for line, invite in parsed:
+                    cur.execute("SAVEPOINT import_row")
+                    try:
+                        _write_invites([invite], conn=cur)
+                        imported += 1
+                    except sqlite3.Error as e:
+                        cur.execute("ROLLBACK TO import_row")
+                        errors.append({'line': line, 'error': str(e)})
+                    cur.execute("RELEASE import_row")
+            errors.sort(key=lambda error: error['line'])
+    return {'imported': imported, 'errors': errors}
+
+# --- group commit ---
+# Необязательный режим (GROUP_COMMIT=1): покупки, пришедшие в пределах
+# GROUP_COMMIT_WINDOW секунд, записывает один поток одной транзакцией и одним commit.
+# Каждая покупка идет в своем SAVEPOINT: ошибка одной откатывает только ее.
+# Результат (или исключение) отдается вызывающему только после commit.
+# Очередь писателя ограничена, как и очередь пула базы: сверх GROUP_COMMIT_QUEUE_DEPTH
+# покупка сразу получает DBBusy (503), а не ждет за тысячами других.
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT') == '1'
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0.002))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 256))
+GROUP_COMMIT_QUEUE_DEPTH = int(os.environ.get('GROUP_COMMIT_QUEUE_DEPTH', DB_QUEUE_DEPTH))
+
+class GroupCommitWriter(threading.Thread):
+    def __init__(self, window: float = GROUP_COMMIT_WINDOW, max_batch: int = GROUP_COMMIT_MAX_BATCH,
+                 queue_depth: int = GROUP_COMMIT_QUEUE_DEPTH):
+        super().__init__(name='group-commit-writer', daemon=True)
+        self.window = window
+        self.max_batch = max_batch
+        self.queue_depth = queue_depth
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_depth)
+        self._lock = threading.Lock()
+        self.commits = self.items = self.failed_items = self.rejected = 0
+
+    # fn вызывается как fn(*args, conn=cur, **kwargs) внутри общей транзакции
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise DBBusy(f"group commit queue is full ({self.queue_depth})") from None
+        return future
+
+    def run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._write(batch)
+                        return
+                    batch.append(item)
+                self._write(batch)
+        finally:
+            close_conn()
+
+    def _write(self, batch):
+        outcomes = []
+        try:
+            with transaction() as cur:
+                pending = getattr(_local, 'after_commit', None)
+                if pending is None:
+                    pending = _local.after_commit = []
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    mark = len(pending)
+                    cur.execute("SAVEPOINT group_item")
+                    try:
+                        result = fn(*args, conn=cur, **kwargs)
+                    except Exception as exc:
+                        cur.execute("ROLLBACK TO group_item")
+                        cur.execute("RELEASE group_item")
+                        del pending[mark:]
+                        outcomes.append((future, None, exc))
+                    else:
+                        cur.execute("RELEASE group_item")
+                        outcomes.append((future, result, None))
+        except Exception as exc:
+            # BEGIN или commit не прошел — не записано ничего из пачки. Если упал
+            # BEGIN, фьючерсы еще не запущены: без ответа вызывающие ждали бы вечно.
+            for future, _, _, _ in batch:
+                if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                    future.set_exception(exc)
+            return
+        with self._lock:
+            self.commits += 1
+            self.items += len(outcomes)
+            self.failed_items += sum(1 for _, _, exc in outcomes if exc is not None)
+        for future, result, exc in outcomes:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'commits': self.commits,
+                'items': self.items,
+                'failed_items': self.failed_items,
+                'items_per_commit': self.items / self.commits if self.commits else 0.0,
+                'queued': self._queue.qsize(),
+                'queue_depth': self.queue_depth,
+                'rejected': self.rejected,
+            }
+
+purchase_writer: Optional[GroupCommitWriter] = None
+
+def start_group_commit(window: float = GROUP_COMMIT_WINDOW, max_batch: int = GROUP_COMMIT_MAX_BATCH,
+                       queue_depth: int = GROUP_COMMIT_QUEUE_DEPTH) -> GroupCommitWriter:
+    global purchase_writer
+    purchase_writer = GroupCommitWriter(window, max_batch, queue_depth)
+    purchase_writer.start()
+    return purchase_writer
+
+def stop_group_commit():
+    global purchase_writer
+    if purchase_writer is not None:
+        purchase_writer.stop()
+        purchase_writer = None
+
+# Покупка через общий писатель; без запущенного писателя — обычный complete_purchase.
+# С idempotency_key — idempotent_purchase.
+def submit_purchase(buyer_tg_id: str, stars_count: int, coupon_code: Optional[str] = None,
+                    idempotency_key: Optional[str] = None) -> Future:
+    if idempotency_key is None:
+        fn, args = complete_purchase, (buyer_tg_id, stars_count, coupon_code)
+    else:
+        fn, args = idempotent_purchase, (idempotency_key, buyer_tg_id, stars_count, coupon_code)
+    if purchase_writer is None:
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+    return purchase_writer.submit(fn, *args)
+
+# --- idempotency ---
+# Бот повторяет /purchase по таймауту. Покупка с Idempotency-Key записывает ключ
+# с результатом в той же транзакции, что и саму покупку; повтор с тем же ключом
+# получает сохраненный результат и не трогает купоны, рефералы и покупки.
+# Параллельные повторы упираются в BEGIN IMMEDIATE: второй видит ключ первого.
+# Перед таблицей — LRU-кэш процесса, попадание в него не доходит до базы.
+# Ключи живут IDEMPOTENCY_TTL секунд, потом их удаляет IdempotencySweeper.
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 86400.0))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_SWEEP_INTERVAL = float(os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', 600.0))
+IDEMPOTENCY_SWEEP_BATCH = int(os.environ.get('IDEMPOTENCY_SWEEP_BATCH', 1000))
+IDEMPOTENCY_SWEEP_PAUSE = float(os.environ.get('IDEMPOTENCY_SWEEP_PAUSE', 0.05))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+GET_IDEMPOTENCY_SQL = "SELECT request, result, created_at FROM idempotency_keys WHERE key = ? AND created_at > ?"
+
+PUT_IDEMPOTENCY_SQL = """
+    INSERT OR REPLACE INTO idempotency_keys(key, request, result, created_at) VALUES (?,?,?,?)
+"""
+
+SWEEP_IDEMPOTENCY_SQL = """
+    DELETE FROM idempotency_keys WHERE key IN (
+        SELECT key FROM idempotency_keys WHERE created_at <= ? LIMIT ?
+    )
+"""
+
+# Кэш хранит ключ -> (request, result); запись в кэше живет не дольше ключа в таблице:
+# прочитанный из базы ключ кэшируется на остаток created_at + IDEMPOTENCY_TTL
+idempotency_cache = LRUCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL)
+
+IDEMPOTENT_REPLAYS = metrics.Counter('referral_idempotent_replays_total',
+                                     "Повторы покупки по Idempotency-Key", ('source',))
+
+# Ключ уже использован для покупки с другими параметрами
+class IdempotencyConflict(ValueError):
+    pass
+
+def _purchase_request(buyer_tg_id: str, stars_count: int, coupon_code: Optional[str]) -> str:
+    return json.dumps([buyer_tg_id, stars_count, coupon_code or None], separators=(',', ':'))
+
+def _replay(key: str, stored: Tuple[str, Dict[str, Any]], request: str) -> Dict[str, Any]:
+    if stored[0] != request:
+        raise IdempotencyConflict(f"idempotency key {key!r} was used for a different purchase")
+    return stored[1]
+
+# Результат из кэша процесса без обращения к базе; None — ключа в кэше нет
+def cached_purchase(key: str, buyer_tg_id: str, stars_count: int,
+                    coupon_code: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    stored = idempotency_cache.get(key)
+    if stored is None:
+        return None
+    result = _replay(key, stored, _purchase_request(buyer_tg_id, stars_count, coupon_code))
+    IDEMPOTENT_REPLAYS.inc(source='cache')
+    return result
+
+@metrics.timed
+def idempotent_purchase(key: str, buyer_tg_id: str, stars_count: int, coupon_code: Optional[str] = None,
+                        conn: Optional[DBHandle] = None) -> Dict[str, Any]:
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"idempotency key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    cached = cached_purchase(key, buyer_tg_id, stars_count, coupon_code)
+    if cached is not None:
+        return cached
+    request = _purchase_request(buyer_tg_id, stars_count, coupon_code)
+    with transaction(conn) as cur:
+        ts = now_ts()
+        row = cur.execute(GET_IDEMPOTENCY_SQL, (key, ts - IDEMPOTENCY_TTL)).fetchone()
+        if row is not None:
+            stored = (row[0], json.loads(row[1]))
+            idempotency_cache.put(key, stored, ttl=row[2] + IDEMPOTENCY_TTL - ts)
+            result = _replay(key, stored, request)
+            IDEMPOTENT_REPLAYS.inc(source='db')
+            return result
+        result = complete_purchase(buyer_tg_id, stars_count, coupon_code, conn=cur)
+        cur.execute(PUT_IDEMPOTENCY_SQL, (key, request, json.dumps(result, separators=(',', ':')), ts))
+        after_commit(lambda: idempotency_cache.put(key, (request, result)))
+    return result
+
+def sweep_idempotency_keys(batch_size: int = IDEMPOTENCY_SWEEP_BATCH,
+                           pause: float = IDEMPOTENCY_SWEEP_PAUSE) -> int:
+    cutoff = now_ts() - IDEMPOTENCY_TTL
+    deleted = 0
+    while True:
+        with transaction() as cur:
+            n = cur.execute(SWEEP_IDEMPOTENCY_SQL, (cutoff, batch_size)).rowcount
+        deleted += n
+        if n < batch_size:
+            return deleted
+        time.sleep(pause)
+
+def idempotency_stats() -> Dict[str, Any]:
+    return idempotency_cache.stats()
+
+class IdempotencySweeper(PeriodicWorker):
+    def __init__(self, interval: float = IDEMPOTENCY_SWEEP_INTERVAL,
+                 batch_size: int = IDEMPOTENCY_SWEEP_BATCH):
+        super().__init__('idempotency-sweeper', interval)
+        self.batch_size = batch_size
+
+    def tick(self):
+        sweep_idempotency_keys(self.batch_size)
+
+# --- expiry ---
+# Фоновый перевод истекших купонов в 'expired'. Идет пачками по EXPIRY_BATCH строк,
+# каждая пачка — своя короткая транзакция, между пачками пауза, чтобы покупки
+# успевали взять блокировку записи.
+EXPIRY_INTERVAL = float(os.environ.get('EXPIRY_INTERVAL', 60.0))
+EXPIRY_BATCH = int(os.environ.get('EXPIRY_BATCH', 500))
+EXPIRY_PAUSE = float(os.environ.get('EXPIRY_PAUSE', 0.05))
+
+EXPIRE_BATCH_SQL = """
+    UPDATE coupons SET status = 'expired'
+    WHERE rowid IN (
+        SELECT rowid FROM coupons WHERE status = 'active' AND expires_at <= ? LIMIT ?
+    )
+    RETURNING code, coupon_type
+"""
+
+_expiry_lock = threading.Lock()
+_expiry_stats = {
+    'runs': 0,
+    'expired_total': 0,
+    'last_expired': 0,
+    'last_batches': 0,
+    'last_seconds': 0.0,
+    'last_run_at': None,
+}
+
+@metrics.timed
+def expire_coupons(batch_size: int = EXPIRY_BATCH, pause: float = EXPIRY_PAUSE) -> int:
+    started = time.perf_counter()
+    ts = now_ts()
+    expired = batches = 0
+    while True:
+        with transaction() as cur:
+            rows = cur.execute(EXPIRE_BATCH_SQL, (ts, batch_size)).fetchall()
+            deltas: Counter = Counter()
+            for code, coupon_type in rows:
+                invalidate_coupon(code)
+                deltas[coupon_stat_key(coupon_type, 'active')] -= 1
+                deltas[coupon_stat_key(coupon_type, 'expired')] += 1
+            bump_stats(cur, deltas)
+        expired += len(rows)
+        batches += 1
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+    with _expiry_lock:
+        _expiry_stats['runs'] += 1
+        _expiry_stats['expired_total'] += expired
+        _expiry_stats['last_expired'] = expired
+        _expiry_stats['last_batches'] = batches
+        _expiry_stats['last_seconds'] = time.perf_counter() - started
+        _expiry_stats['last_run_at'] = ts
+    return expired
+
+def expiry_stats() -> Dict[str, Any]:
+    with _expiry_lock:
+        return dict(_expiry_stats)
+
+class ExpirySweeper(PeriodicWorker):
+    def __init__(self, interval: float = EXPIRY_INTERVAL, batch_size: int = EXPIRY_BATCH,
+                 pause: float = EXPIRY_PAUSE):
+        super().__init__('expiry-sweeper', interval)
+        self.batch_size, self.pause = batch_size, pause
+
+    def tick(self):
+        expire_coupons(self.batch_size, self.pause)
+
+# --- Admin helpers ---
+PAGE_SIZE = 50
+
+# Курсор страницы — (created_at, code) крайней строки
+Cursor = Tuple[int, str]
+
+def _list_coupons_select(source: str = 'coupons') -> str:
+    return f"""
+    SELECT 
+        c.code, c.coupon_type, c.discount_percent, c.stars_count, c.min_stars,
+        c.owner_tg_id,
+        u_owner.tg_username as owner_username,
+        c.inviter_tg_id,
+        u_inviter.tg_username as inviter_username,
+        c.invited_tg_id,
+        u_invited.tg_username as invited_username,
+        c.status,
+        c.created_at, c.expires_at, c.used_at
+    FROM {source} c
+    LEFT JOIN users u_owner ON c.owner_tg_id = u_owner.tg_id
+    LEFT JOIN users u_inviter ON c.inviter_tg_id = u_inviter.tg_id
+    LEFT JOIN users u_invited ON c.invited_tg_id = u_invited.tg_id
+"""
+
+_LIST_COUPONS_SELECT = _list_coupons_select()
+
+# Keyset-пагинация по индексу idx_coupons_created: страница стоит O(limit)
+# независимо от размера таблицы, в отличие от OFFSET или fetchall().
+LIST_COUPONS_SQL = _LIST_COUPONS_SELECT + """
+    ORDER BY c.created_at DESC, c.code DESC LIMIT ?
+"""
+
+LIST_COUPONS_BEFORE_SQL = _LIST_COUPONS_SELECT + """
+    WHERE (c.created_at, c.code) < (?, ?)
+    ORDER BY c.created_at DESC, c.code DESC LIMIT ?
+"""
+
+LIST_COUPONS_AFTER_SQL = _LIST_COUPONS_SELECT + """
+    WHERE (c.created_at, c.code) > (?, ?)
+    ORDER BY c.created_at ASC, c.code ASC LIMIT ?
+"""
+
+# С архивом: страница — слияние двух упорядоченных индексов (idx_coupons_created
+# и idx_coupons_archive_created), пользователи подтягиваются только для нее;
+# внешний ORDER BY сортирует не больше limit строк.
+# ?1/?2 — курсор, ?3 — limit (без курсора limit — ?1).
+_COUPON_COLUMNS = ("code, coupon_type, discount_percent, stars_count, min_stars, owner_tg_id, "
+                   "inviter_tg_id, invited_tg_id, status, created_at, expires_at, used_at")
+
+def _list_all_coupons_sql(where: str, order: str, limit: str) -> str:
+    return f"""
+    WITH page AS (
+        SELECT {_COUPON_COLUMNS} FROM coupons {where}
+        UNION ALL
+        SELECT {_COUPON_COLUMNS} FROM coupons_archive {where}
+        ORDER BY created_at {order}, code {order} LIMIT {limit}
+    )""" + _list_coupons_select('page') + f"""
+    ORDER BY c.created_at {order}, c.code {order}
+"""
+
+LIST_ALL_COUPONS_SQL = _list_all_coupons_sql('', 'DESC', '?1')
+LIST_ALL_COUPONS_BEFORE_SQL = _list_all_coupons_sql('WHERE (created_at, code) < (?1, ?2)', 'DESC', '?3')
+LIST_ALL_COUPONS_AFTER_SQL = _list_all_coupons_sql('WHERE (created_at, code) > (?1, ?2)', 'ASC', '?3')
+
+# Фильтры дашборда (ключи COUPON_FILTERS), все через индексы:
+#   code — префикс кода, диапазон по первичному ключу: code >= 'AB3' AND code < 'AB4';
+#     префикс не короче SEARCH_CODE_PREFIX_MIN: найденные строки сортируются по
+#     created_at, и с 3 символами из 32 это ~1/32768 купонов, а не половина таблицы;
+#   tg_id/username + role — по индексу (<роль>_tg_id, created_at, code), по части
+#     UNION ALL на каждую пару (роль, tg_id): каждая часть уже упорядочена, слияние
+#     без сортировки; купон, найденный по предыдущей роли, следующие исключают;
+#   username — tg_id из users по idx_users_username (COLLATE NOCASE), не больше
+#     SEARCH_MAX_USERS (каждый добавляет части в UNION ALL);
+#   status used/expired — по частичному idx_coupons_closed_created (их малая доля,
+#     сканировать ради них idx_coupons_created долго); active, coupon_type,
+#     created_from/created_until — поверх idx_coupons_created. Если по stats купонов
+#     с таким coupon_type/status нет ни в таблице, ни в архиве — сразу пустой ответ,
+#     иначе обход idx_coupons_created дошел бы до конца.
+# Статистики (ANALYZE) нет, поэтому при tg_id/username или префиксе кода остальные
+# условия пишутся как +column: планировщик не выберет по ним менее избирательный индекс.
+# Страница — не больше limit строк; ее сортирует только внешний ORDER BY.
+# Пагинация та же, что у list_coupons: keyset по (created_at, code).
+COUPON_FILTERS = ('code', 'tg_id', 'role', 'username', 'status', 'coupon_type',
+                  'created_from', 'created_until')
+TG_ROLES = {'owner': 'owner_tg_id', 'inviter': 'inviter_tg_id', 'invited': 'invited_tg_id'}
+SEARCH_CODE_PREFIX_MIN = int(os.environ.get('SEARCH_CODE_PREFIX_MIN', 3))
+SEARCH_MAX_USERS = int(os.environ.get('SEARCH_MAX_USERS', 10))
+
+USERS_BY_USERNAME_SQL = "SELECT tg_id FROM users WHERE tg_username = ? COLLATE NOCASE"
+
+# Верхняя граница префикса: последний символ + 1 (коды — ASCII)
+def code_prefix_range(prefix: str) -> Tuple[str, str]:
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Части UNION ALL: по таблице (и архиву), роли и tg_id; одни и те же условия в каждой.
+# Купон пригласившего попадает и в owner, и в inviter: часть роли пропускает купоны,
+# которые уже нашли по предыдущим ролям. UNION убрал бы дубли сам, но сравнивает
+# строки целиком и сортирует каждую часть во временном B-дереве.
+def _search_page_sql(conditions: List[str], roles: List[str], tg_count: int,
+                     order: str, include_archived: bool) -> str:
+    tg_list = ', '.join(f':tg{i}' for i in range(tg_count))
+    arms = []
+    for source in ('coupons', 'coupons_archive') if include_archived else ('coupons',):
+        for role_index, role in enumerate(roles or [None]):
+            # tg_id по одному: IN (...) по индексу роли уже не в порядке страницы
+            for tg in range(tg_count) if role is not None else [None]:
+                where = list(conditions)
+                if role is not None:
+                    where.append(f"{TG_ROLES[role]} = :tg{tg}")
+                    where.extend(f"({TG_ROLES[prev]} IS NULL OR +{TG_ROLES[prev]} NOT IN ({tg_list}))"
+                                 for prev in roles[:role_index])
+                arms.append(f"SELECT {_COUPON_COLUMNS} FROM {source}"
+                            + (f" WHERE {' AND '.join(where)}" if where else ''))
+    return f"""
+        {' UNION ALL '.join(arms)}
+        ORDER BY created_at {order}, code {order} LIMIT :limit"""
+
+def _search_coupons_sql(conditions: List[str], roles: List[str], tg_count: int,
+                        order: str, include_archived: bool) -> str:
+    page = _search_page_sql(conditions, roles, tg_count, order, include_archived)
+    return f"""
+    WITH page AS ({page}
+    )""" + _list_coupons_select('page') + f"""
+    ORDER BY c.created_at {order}, c.code {order}
+"""
+
+def has_filters(filters: Optional[Dict[str, Any]]) -> bool:
+    return bool(filters) and any(filters.get(name) not in (None, '') for name in COUPON_FILTERS
+                                 if name != 'role')
+
+@metrics.timed
+def search_coupons(filters: Dict[str, Any], before: Optional[Cursor] = None, after: Optional[Cursor] = None,
+                   limit: int = PAGE_SIZE, include_archived: bool = False) -> List[tuple]:
+    conn = get_conn()
+    params: Dict[str, Any] = {'limit': limit}
+    conditions = []
+    tg_ids = [filters['tg_id']] if filters.get('tg_id') else []
+    username = (filters.get('username') or '').strip().lstrip('@')
+    if username:
+        matched = [row[0] for row in conn.execute(USERS_BY_USERNAME_SQL, (username,))]
+        tg_ids = [tg for tg in matched if tg in tg_ids] if tg_ids else matched
+        if not tg_ids:
+            return []
+    if len(tg_ids) > SEARCH_MAX_USERS:
+        raise ValueError(f"more than {SEARCH_MAX_USERS} users match, narrow the search")
+    roles = []
+    if tg_ids:
+        role = filters.get('role')
+        if role and role not in TG_ROLES:
+            raise ValueError(f"unknown role: {role}")
+        roles = [role] if role else list(TG_ROLES)
+        params.update((f'tg{i}', tg) for i, tg in enumerate(tg_ids))
+
+    code = (filters.get('code') or '').strip().upper()
+    if code:
+        if len(code) < SEARCH_CODE_PREFIX_MIN:
+            raise ValueError(f"code prefix must be at least {SEARCH_CODE_PREFIX_MIN} characters")
+        params['code_lo'], params['code_hi'] = code_prefix_range(code)
+        column = '+code' if tg_ids else 'code'
+        conditions.append(f"{column} >= :code_lo AND {column} < :code_hi")
+    status = filters.get('status')
+    if (status or filters.get('coupon_type')) and not count_coupons(filters.get('coupon_type') or None,
+                                                                      status or None, conn):
+        return []
+    if status:
+        params['status'] = status
+        if tg_ids or code:
+            conditions.append("+status = :status")
+        elif status == 'active':
+            conditions.append("status = :status")
+        else:
+            # условие частичного индекса должно быть в запросе дословно
+            conditions.append("status = :status AND status != 'active'")
+    if filters.get('coupon_type'):
+        params['coupon_type'] = filters['coupon_type']
+        conditions.append("+coupon_type = :coupon_type")
+    if filters.get('created_from') is not None:
+        params['created_from'] = filters['created_from']
+        conditions.append("created_at >= :created_from")
+    if filters.get('created_until') is not None:
+        params['created_until'] = filters['created_until']
+        conditions.append("created_at < :created_until")
+    cursor = after if after is not None else before
+    if cursor is not None:
+        params['cursor_ts'], params['cursor_code'] = cursor
+        conditions.append(f"(created_at, code) {'>' if after is not None else '<'} (:cursor_ts, :cursor_code)")
+
+    order = 'ASC' if after is not None else 'DESC'
+    sql = _search_coupons_sql(conditions, roles, len(tg_ids), order, include_archived)
+    rows = conn.execute(sql, params).fetchall()
+    if after is not None:
+        rows.reverse()
+    return rows
+
+# Купоны от новых к старым: before — страница старше курсора, after — новее.
+# include_archived — вместе с перенесенными в coupons_archive; filters — см. search_coupons.
+@metrics.timed
+def list_coupons(before: Optional[Cursor] = None, after: Optional[Cursor] = None,
+                 limit: int = PAGE_SIZE, include_archived: bool = False,
+                 filters: Optional[Dict[str, Any]] = None) -> List[tuple]:
+    if has_filters(filters):
+        return search_coupons(filters, before, after, limit, include_archived)
+    conn = get_conn()
+    if include_archived:
+        sql, sql_before, sql_after = LIST_ALL_COUPONS_SQL, LIST_ALL_COUPONS_BEFORE_SQL, LIST_ALL_COUPONS_AFTER_SQL
+    else:
+        sql, sql_before, sql_after = LIST_COUPONS_SQL, LIST_COUPONS_BEFORE_SQL, LIST_COUPONS_AFTER_SQL
+    if after is not None:
+        rows = conn.execute(sql_after, (*after, limit)).fetchall()
+        rows.reverse()
+        return rows
+    if before is not None:
+        return conn.execute(sql_before, (*before, limit)).fetchall()
+    return conn.execute(sql, (limit,)).fetchall()
+
+def coupon_cursor(row) -> Cursor:
+    return (row[12], row[0])
+
+# Страница для дашборда: строки плюс курсоры соседних страниц (None, если их нет)
+@metrics.timed
+def coupons_page(before: Optional[Cursor] = None, after: Optional[Cursor] = None,
+                 limit: int = PAGE_SIZE, include_archived: bool = False,
+                 filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Берем на одну строку больше, чтобы узнать, есть ли что-то дальше
+    rows = list_coupons(before, after, limit + 1, include_archived, filters)
+    more = len(rows) > limit
+    if after is not None:
+        rows = rows[1:] if more else rows
+        has_prev, has_next = more, True
+    else:
+        rows = rows[:limit]
+        has_prev, has_next = before is not None, more
+    return {
+        'rows': rows,
+        'prev': coupon_cursor(rows[0]) if rows and has_prev else None,
+        'next': coupon_cursor(rows[-1]) if rows and has_next else None,
+    }
+
+@metrics.timed
+def delete_coupon(code: str) -> Dict[str, Any]:
+    with transaction() as cur:
+        coupon = cur.execute(
+            "DELETE FROM coupons WHERE code = ? RETURNING coupon_type, status", (code,)
+        ).fetchone()
+        if coupon is None:
+            coupon = cur.execute(
+                "DELETE FROM coupons_archive WHERE code = ? RETURNING coupon_type, status", (code,)
+            ).fetchone()
+        deleted = coupon is not None
+        if deleted:
+            bump_stats(cur, {coupon_stat_key(*coupon): -1})
+        invalidate_coupon(code)
+
+    return {'ok': deleted, 'message': 'Coupon deleted' if deleted else 'Coupon not found'}
+
+# --- archival ---
+# Used/expired купоны и completed рефералы, закрытые раньше чем ARCHIVE_RETENTION_DAYS
+# назад, переносятся в coupons_archive/referrals_archive пачками по ARCHIVE_BATCH
+# (DELETE ... RETURNING и вставка в архив в одной транзакции). Горячие таблицы и
+# их индексы остаются маленькими и помещаются в кэш страниц. Освободившиеся
+# страницы возвращаются incremental vacuum (если база в режиме auto_vacuum=INCREMENTAL).
+# Счетчики stats архивные строки по-прежнему учитывают.
+ARCHIVE_RETENTION_DAYS = float(os.environ.get('ARCHIVE_RETENTION_DAYS', 90))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600.0))
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 1000))
+ARCHIVE_PAUSE = float(os.environ.get('ARCHIVE_PAUSE', 0.05))
+ARCHIVE_VACUUM_PAGES = int(os.environ.get('ARCHIVE_VACUUM_PAGES', 2000))  # за один шаг
+
+ARCHIVE_COUPONS_SQL = f"""
+    DELETE FROM coupons WHERE rowid IN (
+        SELECT rowid FROM coupons
+        WHERE status IN ('used', 'expired') AND COALESCE(used_at, expires_at) < ? LIMIT ?
+    )
+    RETURNING {_COUPON_COLUMNS}
+"""
+
+INSERT_COUPONS_ARCHIVE_SQL = f"""
+    INSERT INTO coupons_archive({_COUPON_COLUMNS}, archived_at)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+_REFERRAL_COLUMNS = ("id, inviter_tg_id, invited_tg_id, inviter_coupon_code, invited_coupon_code, "
+                     "status, created_at, completed_at")
+
+ARCHIVE_REFERRALS_SQL = f"""
+    DELETE FROM referrals WHERE rowid IN (
+        SELECT rowid FROM referrals WHERE status = 'completed' AND completed_at < ? LIMIT ?
+    )
+    RETURNING {_REFERRAL_COLUMNS}
+"""
+
+INSERT_REFERRALS_ARCHIVE_SQL = f"""
+    INSERT INTO referrals_archive({_REFERRAL_COLUMNS}, archived_at) VALUES (?,?,?,?,?,?,?,?,?)
+"""
+
+_archive_lock = threading.Lock()
+_archive_stats = {
+    'runs': 0,
+    'coupons_archived_total': 0,
+    'referrals_archived_total': 0,
+    'pages_vacuumed_total': 0,
+    'last_coupons': 0,
+    'last_referrals': 0,
+    'last_batches': 0,
+    'last_seconds': 0.0,
+    'last_run_at': None,
+}
+
+def _archive_table(delete_sql: str, insert_sql: str, cutoff: int, ts: int,
+                   batch_size: int, pause: float, invalidate: bool = False) -> Tuple[int, int]:
+    moved = batches = 0
+    while True:
+        with transaction() as cur:
+            rows = cur.execute(delete_sql, (cutoff, batch_size)).fetchall()
+            cur.executemany(insert_sql, [(*row, ts) for row in rows])
+            if invalidate:
+                for row in rows:
+                    invalidate_coupon(row[0])
+        moved += len(rows)
+        batches += 1
+        if len(rows) < batch_size:
+            return moved, batches
+        time.sleep(pause)
+
+# Свободные страницы в конец файла и отрезать, по max_pages за шаг, чтобы
+# не держать блокировку записи долго. 0, если incremental vacuum выключен.
+def incremental_vacuum(max_pages: int = ARCHIVE_VACUUM_PAGES, pause: float = ARCHIVE_PAUSE) -> int:
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    vacuumed = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            return vacuumed
+        # execute() делает один шаг оператора и освобождает одну страницу;
+        # executescript() выполняет его до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        vacuumed += min(free, max_pages)
+        if free <= max_pages:
+            return vacuumed
+        time.sleep(pause)
+
+@metrics.timed
+def archive_old_rows(retention_days: float = ARCHIVE_RETENTION_DAYS, batch_size: int = ARCHIVE_BATCH,
+                     pause: float = ARCHIVE_PAUSE, vacuum: bool = True) -> Dict[str, int]:
+    started = time.perf_counter()
+    ts = now_ts()
+    cutoff = ts - int(retention_days * 86400)
+    coupons, coupon_batches = _archive_table(ARCHIVE_COUPONS_SQL, INSERT_COUPONS_ARCHIVE_SQL,
+                                             cutoff, ts, batch_size, pause, invalidate=True)
+    referrals, referral_batches = _archive_table(ARCHIVE_REFERRALS_SQL, INSERT_REFERRALS_ARCHIVE_SQL,
+                                                 cutoff, ts, batch_size, pause)
+    pages = incremental_vacuum(pause=pause) if vacuum and (coupons or referrals) else 0
+    with _archive_lock:
+        _archive_stats['runs'] += 1
+        _archive_stats['coupons_archived_total'] += coupons
+        _archive_stats['referrals_archived_total'] += referrals
+        _archive_stats['pages_vacuumed_total'] += pages
+        _archive_stats['last_coupons'] = coupons
+        _archive_stats['last_referrals'] = referrals
+        _archive_stats['last_batches'] = coupon_batches + referral_batches
+        _archive_stats['last_seconds'] = time.perf_counter() - started
+        _archive_stats['last_run_at'] = ts
+    return {'coupons': coupons, 'referrals': referrals, 'pages_vacuumed': pages}
+
+def archive_stats() -> Dict[str, Any]:
+    with _archive_lock:
+        return dict(_archive_stats)
+
+class Archiver(PeriodicWorker):
+    def __init__(self, interval: float = ARCHIVE_INTERVAL, retention_days: float = ARCHIVE_RETENTION_DAYS,
+                 batch_size: int = ARCHIVE_BATCH, pause: float = ARCHIVE_PAUSE):
+        super().__init__('archiver', interval)
+        self.retention_days, self.batch_size, self.pause = retention_days, batch_size, pause
+
+    def tick(self):
+        archive_old_rows(self.retention_days, self.batch_size, self.pause)
+
+# --- Export ---
+# Выгрузка таблицы кусками по EXPORT_CHUNK строк: каждый кусок — отдельный
+# короткий запрос с keyset-курсором (created_at, ключ), поэтому память не
+# растет с размером таблицы и долгая выгрузка не держит снимок WAL.
+EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', 1000))
+
+# таблица -> (колонки, ключ для однозначного порядка, есть ли status)
+EXPORT_TABLES = {
+    'coupons': (('code', 'coupon_type', 'discount_percent', 'stars_count', 'min_stars',
+                 'owner_tg_id', 'inviter_tg_id', 'invited_tg_id', 'status',
+                 'created_at', 'expires_at', 'used_at'), 'code', True),
+    'referrals': (('id', 'inviter_tg_id', 'invited_tg_id', 'inviter_coupon_code',
+                   'invited_coupon_code', 'status', 'created_at', 'completed_at'), 'id', True),
+    'purchases': (('id', 'buyer_tg_id', 'stars_count', 'coupon_code', 'discount_percent',
+                   'created_at'), 'id', False),
+}
+
+# Архивные таблицы (см. archive_old_rows) с теми же колонками. Ключи не
+# пересекаются с горячими: коды уникальны по обеим таблицам, id рефералов —
+# AUTOINCREMENT и при переносе сохраняются.
+EXPORT_ARCHIVES = {'coupons': 'coupons_archive', 'referrals': 'referrals_archive'}
+
+# Кусок читается двумя запросами: хвост строк с тем же created_at, что у курсора
+# (created_at = ? AND key > ?), затем следующие (created_at > ? AND created_at < until).
+# Одно сравнение (created_at, id) > (?, ?) SQLite не ведет по rowid в индексе.
+def _export_sql(table: str, where: str, source: Optional[str] = None) -> str:
+    columns, key, has_status = EXPORT_TABLES[table]
+    return f"""
+    SELECT {', '.join(columns)} FROM {source or table}
+    WHERE {where} AND {'(?3 IS NULL OR status = ?3)' if has_status else '?3 IS NULL'}
+    ORDER BY created_at, {key} LIMIT ?4
+"""
+
+# Ключ — таблица или (таблица, архив).
+# ?1/?2 — created_at и ключ курсора, ?3 — status или NULL, ?4 — limit
+EXPORT_TAIL_SQL = {table: _export_sql(table, f"created_at = ?1 AND {key} > ?2")
+                   for table, (_, key, _) in EXPORT_TABLES.items()}
+# ?1/?2 — created_at в (?1, ?2), ?3 — status или NULL, ?4 — limit
+EXPORT_RANGE_SQL = {table: _export_sql(table, "created_at > ?1 AND created_at < ?2")
+                    for table in EXPORT_TABLES}
+for _table, _archive in EXPORT_ARCHIVES.items():
+    EXPORT_TAIL_SQL[_table, _archive] = _export_sql(
+        _table, f"created_at = ?1 AND {EXPORT_TABLES[_table][1]} > ?2", _archive)
+    EXPORT_RANGE_SQL[_table, _archive] = _export_sql(
+        _table, "created_at > ?1 AND created_at < ?2", _archive)
+
+EXPORT_MAX_TS = 2**62
+
+def _export_source(conn: sqlite3.Connection, sql_key, start: int, until: int, status: Optional[str],
+                   after: Optional[Cursor], limit: int) -> List[tuple]:
+    rows = []
+    if after is not None:
+        rows = conn.execute(EXPORT_TAIL_SQL[sql_key], (*after, status, limit)).fetchall()
+    if len(rows) < limit:
+        rows += conn.execute(EXPORT_RANGE_SQL[sql_key],
+                             (start, until, status, limit - len(rows))).fetchall()
+    return rows
+
+# Следующий кусок и курсор для продолжения (None — это был последний кусок).
+# since — включительно, until — не включительно. include_archived — вместе с
+# архивной таблицей: из обеих берется по limit строк от одного курсора, слияние
+# по (created_at, ключ) обрезается до limit, так что порядок общий.
+@metrics.timed
+def export_chunk(table: str, since: Optional[int] = None, until: Optional[int] = None,
+                 status: Optional[str] = None, after: Optional[Cursor] = None,
+                 limit: int = EXPORT_CHUNK, include_archived: bool = True) -> Tuple[List[tuple], Optional[Cursor]]:
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"unknown table: {table}")
+    columns, key, has_status = EXPORT_TABLES[table]
+    if status is not None and not has_status:
+        raise ValueError(f"{table} has no status")
+    until = until if until is not None else EXPORT_MAX_TS
+    start = after[0] if after is not None else (since if since is not None else -EXPORT_MAX_TS) - 1
+    conn = get_conn()
+    rows = _export_source(conn, table, start, until, status, after, limit)
+    archive = EXPORT_ARCHIVES.get(table) if include_archived else None
+    ts_index, key_index = columns.index('created_at'), columns.index(key)
+    if archive is not None:
+        rows += _export_source(conn, (table, archive), start, until, status, after, limit)
+        rows.sort(key=lambda row: (row[ts_index], row[key_index]))
+        rows = rows[:limit]
+    if len(rows) < limit:
+        return rows, None
+    last = rows[-1]
+    return rows, (last[ts_index], last[key_index])
+
+def export_rows(table: str, since: Optional[int] = None, until: Optional[int] = None,
+                status: Optional[str] = None, chunk_size: int = EXPORT_CHUNK,
+                include_archived: bool = True) -> Iterator[List[tuple]]:
+    after = None
+    while True:
+        rows, after = export_chunk(table, since, until, status, after, chunk_size, include_archived)
+        if rows:
+            yield rows
+        if after is None:
+            return
+
+# --- Query plans ---
+# (название, запрос, параметры, индексы, которые план обязан использовать)
+QUERY_PLANS = (
+    ('existing_codes', EXISTING_CODES_SQL, ('[]',),
+     ('sqlite_autoindex_coupons_1', 'sqlite_autoindex_code_pool_1',
+      'sqlite_autoindex_coupons_archive_1')),
+    ('claim_code', CLAIM_CODE_SQL, (), ()),
+    ('get_coupon', GET_COUPON_SQL, ('',), ('sqlite_autoindex_coupons_1',)),
+    ('redeem_coupon', REDEEM_COUPON_SQL, (0, '', '', 0), ('sqlite_autoindex_coupons_1',)),
+    ('complete_referral', COMPLETE_REFERRAL_SQL, (0, ''), ('idx_referrals_invited_coupon',)),
+    ('list_coupons', LIST_COUPONS_SQL, (1,), ('idx_coupons_created', 'sqlite_autoindex_users_1')),
+    ('list_coupons_before', LIST_COUPONS_BEFORE_SQL, (0, '', 1), ('idx_coupons_created',)),
+    ('list_coupons_after', LIST_COUPONS_AFTER_SQL, (0, '', 1), ('idx_coupons_created',)),
+    ('expire_batch', EXPIRE_BATCH_SQL, (0, 1), ('idx_coupons_active_expiry',)),
+    ('idempotency_get', GET_IDEMPOTENCY_SQL, ('', 0), ('PRIMARY KEY',)),
+    ('idempotency_sweep', SWEEP_IDEMPOTENCY_SQL, (0, 1), ('idx_idempotency_created',)),
+    # поиск на дашборде; префикс кода сюда не входит: найденные по первичному ключу
+    # строки сортируются по created_at, их мало благодаря SEARCH_CODE_PREFIX_MIN
+    ('search_username', USERS_BY_USERNAME_SQL, ('',), ('idx_users_username',)),
+    ('search_owner', _search_page_sql(["(created_at, code) < (:cursor_ts, :cursor_code)"], ['owner'], 1,
+                                      'DESC', True),
+     {'tg0': '', 'cursor_ts': 0, 'cursor_code': '', 'limit': 1},
+     ('idx_coupons_owner_created', 'idx_coupons_archive_owner')),
+    ('search_any_role', _search_page_sql([], list(TG_ROLES), 2, 'DESC', True),
+     {'tg0': '', 'tg1': '', 'limit': 1},
+     ('idx_coupons_owner_created', 'idx_coupons_inviter_created', 'idx_coupons_invited_created',
+      'idx_coupons_archive_owner', 'idx_coupons_archive_inviter', 'idx_coupons_archive_invited')),
+    ('search_inviter', _search_page_sql([], ['inviter'], 1, 'DESC', False), {'tg0': '', 'limit': 1},
+     ('idx_coupons_inviter_created',)),
+    ('search_invited', _search_page_sql([], ['invited'], 1, 'ASC', False), {'tg0': '', 'limit': 1},
+     ('idx_coupons_invited_created',)),
+    ('search_status', _search_page_sql(["status = :status AND status != 'active'"], [], 0, 'DESC', False),
+     {'status': '', 'limit': 1}, ('idx_coupons_closed_created',)),
+    ('search_owner_status', _search_page_sql(["+status = :status"], ['owner'], 1, 'DESC', False),
+     {'tg0': '', 'status': '', 'limit': 1}, ('idx_coupons_owner_created',)),
+    ('search_created', _search_page_sql(["created_at >= :created_from", "created_at < :created_until"],
+                                        [], 0, 'DESC', False),
+     {'created_from': 0, 'created_until': 0, 'limit': 1}, ('idx_coupons_created',)),
+    ('archive_coupons', ARCHIVE_COUPONS_SQL, (0, 1), ('idx_coupons_archivable',)),
+    ('archive_referrals', ARCHIVE_REFERRALS_SQL, (0, 1), ('idx_referrals_archivable',)),
+    ('purchases_by_buyer', "SELECT id FROM purchases WHERE buyer_tg_id = ?",
+     ('',), ('idx_purchases_buyer',)),
+    ('export_coupons_tail', EXPORT_TAIL_SQL['coupons'], (0, '', None, 1), ('idx_coupons_created',)),
+    ('export_coupons', EXPORT_RANGE_SQL['coupons'], (0, 1, None, 1), ('idx_coupons_created',)),
+    ('export_referrals_tail', EXPORT_TAIL_SQL['referrals'], (0, 0, None, 1), ('idx_referrals_created',)),
+    ('export_referrals', EXPORT_RANGE_SQL['referrals'], (0, 1, None, 1), ('idx_referrals_created',)),
+    ('export_purchases_tail', EXPORT_TAIL_SQL['purchases'], (0, 0, None, 1), ('idx_purchases_created',)),
+    ('export_purchases', EXPORT_RANGE_SQL['purchases'], (0, 1, None, 1), ('idx_purchases_created',)),
+    ('export_coupons_archive_tail', EXPORT_TAIL_SQL['coupons', 'coupons_archive'], (0, '', None, 1),
+     ('idx_coupons_archive_created',)),
+    ('export_coupons_archive', EXPORT_RANGE_SQL['coupons', 'coupons_archive'], (0, 1, None, 1),
+     ('idx_coupons_archive_created',)),
+    ('export_referrals_archive_tail', EXPORT_TAIL_SQL['referrals', 'referrals_archive'], (0, 0, None, 1),
+     ('idx_referrals_archive_created',)),
+    ('export_referrals_archive', EXPORT_RANGE_SQL['referrals', 'referrals_archive'], (0, 1, None, 1),
+     ('idx_referrals_archive_created',)),
+)
+
+def explain(sql: str, params=()) -> list:
+    return [row[3] for row in get_conn().execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+# Возвращает список проблем: полные сканы таблиц, сортировки через temp b-tree
+# и неиспользованные индексы. Пустой список — все планы в порядке.
+def check_query_plans() -> list:
+    problems = []
+    for name, sql, params, indexes in QUERY_PLANS:
+        plan = explain(sql, params)
+        for detail in plan:
+            if (detail.startswith('SCAN') and ' INDEX ' not in detail) or 'TEMP B-TREE' in detail:
+                problems.append(f"{name}: {detail}")
+        for index in indexes:
+            if not any(index in detail for detail in plan):
+                problems.append(f"{name}: index {index} not used ({'; '.join(plan)})")
+    return problems
@@ -0,0 +1,174 @@
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+# Необязательная трассировка SQL (SQL_TRACE=1) для соединений referral_system.
+# set_trace_callback сообщает о начале каждого выполняемого оператора, включая
+# COMMIT из conn.commit() и каждую строку executemany; оператор считается
+# завершенным при начале следующего или при возврате из execute/executemany/
+# commit/rollback TracedConnection. Время — до первой строки результата:
+# выборка остальных строк через fetch* в него не входит. rows — строки,
+# измененные оператором (по total_changes), у SELECT это 0.
+SQL_TRACE = os.environ.get('SQL_TRACE') == '1'
+SQL_SLOW_MS = float(os.environ.get('SQL_SLOW_MS', 100))
+# Один и тот же оператор чаще этого за запрос — вероятный N+1, пишем в лог
+SQL_REPEAT_WARN = int(os.environ.get('SQL_REPEAT_WARN', 20))
+# Итог по запросу в заголовках X-DB-Queries / X-DB-Time-Ms (только для отладки)
+SQL_TRACE_HEADERS = os.environ.get('SQL_TRACE_HEADERS') == '1'
+
+log = logging.getLogger('referral_system.sql')
+
+_STRING = re.compile(r"'(?:[^']|'')*'|[xX]'[0-9a-fA-F]*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+# Литералы -> ?, списки (?, ?, ...) -> (?, ...), пробелы схлопываются
+@lru_cache(maxsize=4096)
+def normalize(sql: str) -> str:
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('(?, ...)', sql)
+
+
+# --- агрегаты процесса ---
+_lock = threading.Lock()
+_statements: Dict[str, List[float]] = {}  # оператор -> [count, seconds, max, rows]
+
+def _aggregate(statement: str, elapsed: float, rows: int):
+    with _lock:
+        stat = _statements.get(statement)
+        if stat is None:
+            stat = _statements[statement] = [0, 0.0, 0.0, 0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+        stat[3] += rows
+
+def statement_stats(limit: int = 50) -> List[Dict[str, Any]]:
+    with _lock:
+        items = [(sql, *stat) for sql, stat in _statements.items()]
+    items.sort(key=lambda item: item[2], reverse=True)
+    return [{'sql': sql, 'count': count, 'seconds_total': total, 'seconds_max': worst,
+             'seconds_avg': total / count, 'rows': rows}
+            for sql, count, total, worst, rows in items[:limit]]
+
+def reset():
+    with _lock:
+        _statements.clear()
+
+
+# --- итог по HTTP-запросу ---
+class RequestTrace:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, elapsed: float):
+        with self._lock:
+            self.queries += 1
+            self.seconds += elapsed
+            self.statements[statement] += 1
+
+    def repeated(self, threshold: int = SQL_REPEAT_WARN) -> List[tuple]:
+        with self._lock:
+            return [(sql, n) for sql, n in self.statements.most_common() if n > threshold]
+
+# DBExecutor копирует контекст в поток пула, так что запись доходит до запроса
+current_request: contextvars.ContextVar[Optional[RequestTrace]] = \
+    contextvars.ContextVar('sql_request_trace', default=None)
+
+
+# --- хук соединения ---
+_local = threading.local()
+
+def _finish():
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        return
+    _local.pending = None
+    raw, started, changes_before, conn = pending
+    elapsed = time.perf_counter() - started
+    rows = conn.total_changes - changes_before
+    statement = normalize(raw)
+    _aggregate(statement, elapsed, rows)
+    request = current_request.get()
+    if request is not None:
+        request.add(statement, elapsed)
+    if elapsed * 1000 >= SQL_SLOW_MS:
+        log.warning("slow query %.1f ms, %d rows: %s", elapsed * 1000, rows, statement)
+
+def _trace(conn: sqlite3.Connection, raw: str):
+    _finish()
+    _local.pending = (raw, time.perf_counter(), conn.total_changes, conn)
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(lambda raw: _trace(self, raw))
+
+    def execute(self, *args, **kwargs):
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            _finish()
+
+    def executemany(self, *args, **kwargs):
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            _finish()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            _finish()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            _finish()
+
+
+# --- ASGI ---
+# Заводит RequestTrace на запрос; с SQL_TRACE_HEADERS добавляет итог в заголовки
+# ответа (у потоковых ответов там только то, что выполнено до отправки заголовков).
+class SQLTraceMiddleware:
+    def __init__(self, app, headers: bool = SQL_TRACE_HEADERS):
+        self.app = app
+        self.headers = headers
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        trace = RequestTrace()
+        token = current_request.set(trace)
+
+        async def send_wrapper(message):
+            if self.headers and message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []),
+                                      (b'x-db-queries', str(trace.queries).encode()),
+                                      (b'x-db-time-ms', f"{trace.seconds * 1000:.2f}".encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            for statement, count in trace.repeated():
+                log.warning("%s %s: %d x %s", scope['method'], scope['path'], count, statement)
+            log.debug("%s %s: %d queries, %.2f ms", scope['method'], scope['path'],
+                      trace.queries, trace.seconds * 1000)
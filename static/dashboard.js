@@ -0,0 +1,8 @@
+async function deleteCoupon(code) {
+    if (confirm('Are you sure you want to delete coupon ' + code + '?')) {
+        const response = await fetch(`/coupon/${code}`, { method:'DELETE' });
+        const result = await response.json();
+        if(result.ok) window.location.reload();
+        else alert('Failed to delete coupon: ' + result.message);
+    }
+}
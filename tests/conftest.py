@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import referral_system as rs
+
+
+# Свежая база на тест; кэши процесса get_conn сбрасывает сам при смене DB
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(rs, 'DB', str(tmp_path / 'referral.db'))
+    rs.init_db()
+    yield rs.get_conn()
+    rs.close_conn()
@@ -0,0 +1,32 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+from db_executor import db as db_pool
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(app_module.app)
+
+
+# Пул базы переполнен до начала ответа: 503, а не обрезанная страница
+@pytest.mark.parametrize('url', ['/', '/?code=ABC', '/export/coupons', '/export/referrals?format=ndjson'])
+def test_db_busy_before_response(client, monkeypatch, url):
+    monkeypatch.setattr(db_pool, 'workers', 0)
+    monkeypatch.setattr(db_pool, 'queue_depth', 0)
+    response = client.get(url)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_short_code_prefix(client):
+    assert client.get('/?code=AB').status_code == 400
+
+
+def test_dashboard_and_export(client):
+    invite = app_module.start_invite('1', '2', 10, 20)
+    page = client.get('/?tg_id=1')
+    assert page.status_code == 200 and invite['inviter_coupon'] in page.text
+    export = client.get('/export/coupons')
+    assert export.status_code == 200 and invite['invited_coupon'] in export.text
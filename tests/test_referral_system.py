@@ -0,0 +1,113 @@
+import threading
+
+import pytest
+
+import referral_system as rs
+
+
+def test_query_plans(db):
+    assert rs.check_query_plans() == []
+
+
+def test_redeem_twice(db):
+    invite = rs.start_invite('1', '2', 10, 20)
+    first = rs.complete_purchase('2', 100, invite['invited_coupon'])
+    second = rs.complete_purchase('2', 100, invite['invited_coupon'])
+    assert first['ok'] and first['used_discount_percent'] == 10
+    assert second == {'ok': False, 'reason': 'coupon_not_active'}
+    assert rs.read_stats()['purchases'] == 1
+
+
+# Две покупки с одним купоном из разных соединений одновременно:
+# погасить его должен ровно один UPDATE (REDEEM_COUPON_SQL)
+def test_redeem_race(db):
+    invite = rs.start_invite('1', '2', 10, 20)
+    start = threading.Barrier(8)
+    results = []
+
+    def buy():
+        try:
+            start.wait()
+            results.append(rs.complete_purchase('2', 100, invite['invited_coupon']))
+        finally:
+            rs.close_conn()
+
+    threads = [threading.Thread(target=buy) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    assert sum(result['ok'] for result in results) == 1
+    assert db.execute("SELECT COUNT(*) FROM purchases WHERE coupon_code = ?",
+                      (invite['invited_coupon'],)).fetchone()[0] == 1
+    assert rs.read_stats()['coupons']['invited_discount'] == {'active': 0, 'used': 1}
+
+
+def _exported(table, **kwargs):
+    return [row for chunk in rs.export_rows(table, **kwargs) for row in chunk]
+
+
+def test_export_includes_archive(db):
+    invites = [rs.start_invite(str(i), f'{i}b', 10, 20) for i in range(5)]
+    for i in (0, 2, 3):
+        assert rs.complete_purchase(f'{i}b', 100, invites[i]['invited_coupon'])['ok']
+    before = _exported('coupons'), _exported('referrals')
+
+    archived = rs.archive_old_rows(retention_days=-1, pause=0)
+    assert archived['coupons'] == 3 and archived['referrals'] == 3
+    used = {invites[i]['invited_coupon'] for i in (0, 2, 3)}
+    assert {row[0] for row in db.execute("SELECT code FROM coupons_archive")} == used
+
+    # Куски по 2 строки: курсор проходит вперемешку по таблице и архиву
+    assert _exported('coupons', chunk_size=2) == before[0]
+    assert _exported('referrals', chunk_size=2) == before[1]
+    assert _exported('coupons', status='used') == [row for row in before[0] if row[0] in used]
+
+    hot = _exported('coupons', include_archived=False)
+    assert len(hot) == 7 and not used & {row[0] for row in hot}
+    assert len(_exported('referrals', include_archived=False)) == 2
+
+
+# Счетчики без нулевых: rebuild_stats не пишет ключи, которые bump_stats довел до 0
+def _counters(stats):
+    counters = {('coupons', coupon_type, status): value
+                for coupon_type, statuses in stats['coupons'].items()
+                for status, value in statuses.items()}
+    counters.update((('referrals', status), value) for status, value in stats['referrals'].items())
+    counters.update(purchases=stats['purchases'], discount_percent_total=stats['discount_percent_total'])
+    return {key: value for key, value in counters.items() if value}
+
+
+def test_archive_keeps_stats(db):
+    invite = rs.start_invite('1', '2', 10, 20)
+    rs.complete_purchase('2', 100, invite['invited_coupon'])
+    stats = rs.read_stats()
+    rs.archive_old_rows(retention_days=-1, pause=0)
+    assert rs.read_stats() == stats
+    rs.rebuild_stats()
+    assert _counters(rs.read_stats()) == _counters(stats)
+
+
+# Очередь писателя ограничена: сверх queue_depth покупка сразу получает DBBusy
+def test_group_commit_queue_bound(db):
+    writer = rs.GroupCommitWriter(queue_depth=2)
+    futures = [writer.submit(rs.complete_purchase, '1', 1) for _ in range(2)]
+    with pytest.raises(rs.DBBusy):
+        writer.submit(rs.complete_purchase, '1', 1)
+    assert writer.stats()['rejected'] == 1
+    writer.start()
+    assert all(future.result(timeout=5)['ok'] for future in futures)
+    writer.stop()
+
+
+# Ключ, прочитанный из базы, кэшируется только на остаток своего TTL
+def test_idempotency_cache_deadline(db, monkeypatch):
+    first = rs.idempotent_purchase('k1', '1', 1)
+    db.execute("UPDATE idempotency_keys SET created_at = created_at - ?", (rs.IDEMPOTENCY_TTL - 5,))
+    rs.idempotency_cache.clear()
+    assert rs.idempotent_purchase('k1', '1', 1) == first
+    assert rs.cached_purchase('k1', '1', 1) == first
+    clock = rs.time.monotonic() + 10
+    monkeypatch.setattr(rs.time, 'monotonic', lambda: clock)
+    assert rs.cached_purchase('k1', '1', 1) is None